@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Check `mvf_app.starfile` against the real Relion output in testing/External/job004.
+
+For `micrographs.star` and `RELION_OUTPUT_NODES.star`, every block read by `read_star_loops` must have the expected
+columns, in order, with the expected types (int64 or float64 arrays for numeric columns, lists of str otherwise), and
+every value must match a plain line-by-line parse of the file. When `cryoemtools` is installed, the tables must also
+match `cryoemtools.relionstarparser.read_star` value for value. Finally, tables with empty and whitespace-containing
+strings must survive a `write_star_loop`/`read_star_loop` round trip, and rows appended with `write_star_rows` to a
+loop left open must be read back both by `read_star_loop` and by a reader that, like Relion's, ends a loop at the
+first blank line.
+
+Exits non-zero, listing the problems, if any check fails:
+
+    python benchmarks/check_starfile.py
+"""
+
+import io
+import math
+import numbers
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTING_DIR = os.path.join(REPO_DIR, 'testing', 'External', 'job004')
+sys.path.insert(0, REPO_DIR)
+
+from mvf_app.starfile import (read_star_loop, read_star_loops, table_length, write_star_loop,  # noqa: E402
+                              write_star_rows)
+
+
+STR, INT, FLOAT = 'str', 'int', 'float'
+OPTICS_COLUMNS = [('rlnOpticsGroupName', STR), ('rlnOpticsGroup', INT), ('rlnMicrographOriginalPixelSize', FLOAT),
+                  ('rlnVoltage', FLOAT), ('rlnSphericalAberration', FLOAT), ('rlnAmplitudeContrast', FLOAT),
+                  ('rlnMicrographPixelSize', FLOAT)]
+MICROGRAPHS_COLUMNS = [('rlnMicrographNameNoDW', STR), ('rlnMicrographName', STR), ('rlnOpticsGroup', INT),
+                       ('rlnCtfImage', STR), ('rlnDefocusU', FLOAT), ('rlnDefocusV', FLOAT),
+                       ('rlnCtfAstigmatism', FLOAT), ('rlnDefocusAngle', FLOAT), ('rlnCtfFigureOfMerit', FLOAT),
+                       ('rlnCtfMaxResolution', FLOAT), ('rlnMicrographMetadata', STR), ('rlnAccumMotionTotal', FLOAT),
+                       ('rlnAccumMotionEarly', FLOAT), ('rlnAccumMotionLate', FLOAT)]
+# File -> block -> (columns and types, row count)
+EXPECTED = {
+    'micrographs.star': OrderedDict((('optics', (OPTICS_COLUMNS, 1)), ('micrographs', (MICROGRAPHS_COLUMNS, 50)))),
+    'RELION_OUTPUT_NODES.star': OrderedDict((('output_nodes', ([('rlnPipeLineNodeName', STR),
+                                                                ('rlnPipeLineNodeType', INT)], 1)),)),
+}
+
+
+def value_type(values):
+    if isinstance(values, np.ndarray):
+        return {'i': INT, 'f': FLOAT}.get(values.dtype.kind, values.dtype.name)
+    kinds = set(STR if isinstance(v, str) else INT if isinstance(v, numbers.Integral) else
+                FLOAT if isinstance(v, numbers.Real) else type(v).__name__ for v in values)
+    return kinds.pop() if len(kinds) == 1 else '/'.join(sorted(kinds))
+
+
+def plain_parse(path):
+    """
+    The simplest possible reading of a file of unquoted `loop_` blocks: block -> column -> list of str
+    """
+    tables = OrderedDict()
+    with open(path, 'r') as fh:
+        lines = [line.strip() for line in fh]
+    for line in lines:
+        if not line or line.startswith('#') or line == 'loop_':
+            continue
+        if line.startswith('data_'):
+            table = tables[line[len('data_'):]] = OrderedDict()
+        elif line.startswith('_'):
+            table[line.split()[0][1:]] = []
+        else:
+            for column, value in zip(table.values(), line.split()):
+                column.append(value)
+    return tables
+
+
+def relion_loop_rows(path, block):
+    """
+    Read the data rows of `block` the way Relion does: the loop ends at the first blank line, `data_` line or the end
+    of the file
+    """
+    with open(path, 'r') as fh:
+        lines = [line.strip() for line in fh]
+    start = lines.index('data_' + block) + 1
+    while not lines[start] or lines[start] == 'loop_' or lines[start].startswith('_'):
+        start += 1
+    rows = []
+    for line in lines[start:]:
+        if not line or line.startswith('data_'):
+            break
+        rows.append(line.split())
+    return rows
+
+
+def same_value(a, b):
+    # Numbers are compared by value, so that e.g. 0.53 matches the text '0.530000'
+    if isinstance(a, str) and isinstance(b, str):
+        return a == b
+    try:
+        return math.isclose(float(a), float(b), rel_tol=1e-12, abs_tol=0.0)
+    except ValueError:
+        return False
+
+
+def compare_tables(name, table, reference, problems):
+    if list(table) != list(reference):
+        problems.append("{}: columns {} != {}".format(name, list(table), list(reference)))
+        return
+    for column in table:
+        if len(table[column]) != len(reference[column]):
+            problems.append("{}.{}: {:d} rows != {:d}".format(
+                name, column, len(table[column]), len(reference[column])))
+            continue
+        mismatches = [i for i, (a, b) in enumerate(zip(table[column], reference[column])) if not same_value(a, b)]
+        if mismatches:
+            i = mismatches[0]
+            problems.append("{}.{}: {:d} values differ, first at row {:d}: {!r} != {!r}".format(
+                name, column, len(mismatches), i, table[column][i], reference[column][i]))
+
+
+def check_testing_files(problems):
+    try:
+        import cryoemtools.relionstarparser as rsp
+    except ImportError:
+        rsp = None
+        print("cryoemtools is not installed: skipping the comparison with read_star")
+    for filename, expected_blocks in EXPECTED.items():
+        path = os.path.join(TESTING_DIR, filename)
+        tables = read_star_loops(path)
+        if list(tables) != list(expected_blocks):
+            problems.append("{}: blocks {} != {}".format(filename, list(tables), list(expected_blocks)))
+            continue
+        plain = plain_parse(path)
+        for block, (columns, rows) in expected_blocks.items():
+            name = '{}:data_{}'.format(filename, block)
+            table = tables[block]
+            found = [(column, value_type(values)) for column, values in table.items()]
+            if found != columns:
+                problems.append("{}: columns and types {} != {}".format(name, found, columns))
+            if any(len(values) != rows for values in table.values()):
+                problems.append("{}: expected {:d} rows".format(name, rows))
+            if len(relion_loop_rows(path, block)) != rows:
+                problems.append("{}: a Relion-style read finds {:d} rows, expected {:d}".format(
+                    name, len(relion_loop_rows(path, block)), rows))
+            compare_tables(name + ' vs plain parse', table, plain[block], problems)
+            compare_tables(name + ' unconverted vs plain parse',
+                           read_star_loop(path, block, convert_numeric=False), plain[block], problems)
+            if rsp is not None:
+                reference = rsp.read_star(path, block_list=[block], flatten=True)
+                compare_tables(name + ' vs read_star', table, reference, problems)
+                for column, values in table.items():
+                    if value_type(values) != value_type(reference[column]):
+                        problems.append("{}.{}: {} != read_star's {}".format(name, column, value_type(values),
+                                                                             value_type(reference[column])))
+
+
+def check_round_trip(problems):
+    table = OrderedDict((('name', ['a', '', 'with space', 'z']), ('group', [1, 2, 3, 4]),
+                         ('value', [0.5, 1.25, -3.0, 2.0])))
+    fh = io.StringIO()
+    write_star_loop(fh, table, 'round_trip')
+    fh.seek(0)
+    compare_tables('round trip', read_star_loop(fh, 'round_trip'), table, problems)
+
+
+def check_appended_rows(problems):
+    """
+    Rows appended to a loop left open, as in the progress watcher's selected_micrographs.star, must extend that loop
+    """
+    table = OrderedDict((('name', ['a', 'b', 'c']), ('value', [0.5, 1.25, -3.0])))
+    appended = OrderedDict((('name', ['d', 'with space']), ('value', [2.0, 4.5])))
+    expected = OrderedDict((col, table[col] + appended[col]) for col in table)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'appended.star')
+        with open(path, 'w') as fh:
+            write_star_loop(fh, OrderedDict((('rlnOpticsGroup', [1]),)), 'optics')
+            write_star_loop(fh, table, 'micrographs', terminate=False)
+        with open(path, 'a') as fh:
+            write_star_rows(fh, appended)
+        compare_tables('appended rows', read_star_loop(path, 'micrographs'), expected, problems)
+        rows = relion_loop_rows(path, 'micrographs')
+        if len(rows) != table_length(expected):
+            problems.append("appended rows: a Relion-style read finds {:d} rows, expected {:d}".format(
+                len(rows), table_length(expected)))
+
+
+def main():
+    problems = []
+    check_testing_files(problems)
+    check_round_trip(problems)
+    check_appended_rows(problems)
+    for problem in problems:
+        print("FAIL:", problem)
+    if problems:
+        sys.exit(1)
+    print("All STAR reader checks passed")
+
+
+if __name__ == '__main__':
+    main()
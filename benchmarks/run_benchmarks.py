@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Benchmark the mvf preview pipeline and web server on synthetic data.
+
+Generates a synthetic project (see `synthetic.py`) and times:
+ * `mrc2png` on a detector-sized micrograph and on a CTFFind power spectrum, and `ctf2png` on an _avrot.txt file
+ * a full run of the progress watcher (`mvf_progress_watcher.py`) over `--images` new micrographs
+ * `MotionCtfData.update`, `MotionCtfData.to_datatable_format`, `SummaryStatistics.update` and `progress_updater`
+   (with the size of its JSON payload) for micrographs tables of each of `--sizes` rows
+ * `mvf_app.starfile.read_star_loop`, for all and for selected columns, against `cryoemtools`' `read_star` (when
+   installed), checking that both give the same values. The reader is checked against real Relion output by
+   `check_starfile.py`.
+
+Results are written as JSON, keyed by benchmark name, along with the commit and machine they were measured on. Pass a
+previous results file with `--compare` to print the change for each benchmark and exit non-zero on regressions:
+
+    python benchmarks/run_benchmarks.py --detector k3 --output before.json
+    git checkout my-branch
+    python benchmarks/run_benchmarks.py --detector k3 --output after.json --compare before.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(REPO_DIR, 'scripts')
+WATCHER_PATH = os.path.join(SCRIPTS_DIR, 'mvf_progress_watcher.py')
+sys.path.insert(0, REPO_DIR)
+
+
+def measure(func, repeats, setup=None):
+    """
+    Call `func` `repeats` times, calling `setup` (untimed) before each, and summarize the wall times. `func` may
+    return None, or a dict of extra values (e.g. payload sizes) to report alongside the timings.
+
+    Returns
+    -------
+    dict
+        'seconds' (the median), 'min', 'max' and 'repeats', plus anything in the dict returned by the last `func` call
+    """
+    times = []
+    extra = None
+    for _ in range(repeats):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        extra = func()
+        times.append(time.perf_counter() - started)
+    result = {'seconds': statistics.median(times), 'min': min(times), 'max': max(times), 'repeats': repeats}
+    if isinstance(extra, dict):
+        result.update(extra)
+    return result
+
+
+def ignore_result(func, *args, **kwargs):
+    # For timing functions whose return value should not be mistaken for `measure` extras
+    def call():
+        func(*args, **kwargs)
+    return call
+
+
+def skipped(reason):
+    return {'skipped': reason}
+
+
+def load_watcher():
+    spec = importlib.util.spec_from_file_location('mvf_progress_watcher', WATCHER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_images(work_dir, detector, repeats):
+    results = {}
+    project = os.path.join(work_dir, 'images')
+    synthetic.write_star_files(project, 1)
+    synthetic.write_images(project, 1, detector)
+    name = synthetic.micrograph_name(0)
+    micrograph = os.path.join(project, synthetic.MOCO_DIR, 'Micrographs', name + '.mrc')
+    ctf_base = os.path.join(project, synthetic.CTF_DIR, 'Micrographs', name + '_noDW')
+    output_dir = os.path.join(project, 'Previews')
+    os.makedirs(output_dir, exist_ok=True)
+
+    try:
+        watcher = load_watcher()
+    except ImportError as error:
+        reason = 'cannot import the progress watcher: {}'.format(error)
+        return {'mrc2png_micrograph': skipped(reason), 'mrc2png_fft': skipped(reason), 'ctf2png': skipped(reason)}
+
+    results['mrc2png_micrograph'] = measure(
+        lambda: watcher.mrc2png(micrograph, output_dir=output_dir, resize=1448, sigma_contrast=2.0), repeats)
+    results['mrc2png_fft'] = measure(lambda: watcher.mrc2png(ctf_base + '.ctf', output_dir=output_dir), repeats)
+    if shutil.which('gnuplot') and shutil.which('gawk'):
+        results['ctf2png'] = measure(lambda: watcher.ctf2png(ctf_base + '_avrot.txt', output_dir=output_dir),
+                                     repeats)
+    else:
+        results['ctf2png'] = skipped('gnuplot and gawk are required')
+    return results
+
+
+def bench_watcher(work_dir, detector, images, repeats, threads):
+    project = os.path.join(work_dir, 'watcher')
+    ctf_star = synthetic.write_star_files(project, images)
+    synthetic.write_images(project, images, detector)
+    job_dir = synthetic.EXTERNAL_DIR + os.sep
+
+    def reset():
+        shutil.rmtree(os.path.join(project, 'Previews'), ignore_errors=True)
+        shutil.rmtree(os.path.join(project, job_dir), ignore_errors=True)
+        os.makedirs(os.path.join(project, job_dir))
+
+    def run():
+        completed = subprocess.run([sys.executable, WATCHER_PATH, '--o', job_dir, '--in_mics', ctf_star,
+                                    '--j', str(threads)], cwd=project, env=env, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE)
+        if completed.returncode != 0:
+            raise RuntimeError(completed.stderr.decode(errors='replace'))
+        return {'micrographs': images, 'threads': threads}
+
+    env = dict(os.environ, PATH=SCRIPTS_DIR + os.pathsep + os.environ.get('PATH', ''),
+               PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    try:
+        return {'watcher_full_loop': measure(run, repeats, setup=reset)}
+    except RuntimeError as error:
+        return {'watcher_full_loop': skipped('watcher failed: {}'.format(str(error).strip().splitlines()[-1]))}
+
+
+def bench_tables(work_dir, sizes, repeats):
+    results = {}
+    try:
+        from mvf_app.data import MotionCtfData
+        from mvf_app.stats import SummaryStatistics
+        from mvf_app.components import columns_of_interest
+        from mvf_app.starfile import read_star_loop
+    except ImportError as error:
+        for rows in sizes:
+            for name in ('motionctfdata_update', 'to_datatable_format', 'summary_statistics_update',
+                         'read_star_loop', 'read_star_loop_selected'):
+                results['{}[{:d}]'.format(name, rows)] = skipped('cannot import mvf_app: {}'.format(error))
+        return results
+    try:
+        import cryoemtools.relionstarparser as rsp
+    except ImportError:
+        rsp = None
+
+    for rows in sizes:
+        project = os.path.join(work_dir, 'table_{:d}'.format(rows))
+        hint_path = synthetic.write_consolidated_star(project, rows)
+        star_path = os.path.join(project, synthetic.EXTERNAL_DIR, 'micrographs.star')
+
+        results['read_star_loop[{:d}]'.format(rows)] = measure(
+            ignore_result(read_star_loop, star_path, 'micrographs'), repeats)
+        selected = columns_of_interest + ['rlnMicrographName', 'rlnCtfImage']
+        results['read_star_loop_selected[{:d}]'.format(rows)] = measure(
+            ignore_result(read_star_loop, star_path, 'micrographs', columns=selected), repeats)
+        if rsp is not None:
+            results['rsp_read_star[{:d}]'.format(rows)] = measure(
+                ignore_result(rsp.read_star, star_path, block_list=['micrographs'], flatten=True), repeats)
+            fast = read_star_loop(star_path, 'micrographs')
+            reference = rsp.read_star(star_path, block_list=['micrographs'], flatten=True)
+            results['rsp_read_star[{:d}]'.format(rows)]['matches_read_star_loop'] = \
+                list(fast) == list(reference) and all(list(fast[col]) == list(reference[col]) for col in fast)
+        else:
+            results['rsp_read_star[{:d}]'.format(rows)] = skipped('cryoemtools is not installed')
+
+        def update():
+            MotionCtfData(hint_path, init=False).update()
+        results['motionctfdata_update[{:d}]'.format(rows)] = measure(update, repeats)
+
+        loaded = MotionCtfData(hint_path)
+        results['to_datatable_format[{:d}]'.format(rows)] = measure(
+            lambda: loaded.to_datatable_format(columns_of_interest), repeats)
+        results['summary_statistics_update[{:d}]'.format(rows)] = measure(
+            lambda: SummaryStatistics(columns_of_interest).update(loaded.data), repeats)
+    return results
+
+
+def bench_progress_updater(work_dir, sizes, repeats):
+    results = {}
+    os.environ['MVF_PROJECT_DIR'] = os.path.join(work_dir, 'table_{:d}'.format(sizes[0]))
+    try:
+        import plotly.utils
+        from mvf_app import app as mvf
+    except ImportError as error:
+        for rows in sizes:
+            results['progress_updater[{:d}]'.format(rows)] = skipped('cannot import mvf_app.app: {}'.format(error))
+        return results
+
+    for rows in sizes:
+        hint_path = os.path.join(work_dir, 'table_{:d}'.format(rows), '.mvf_progress_hint')
+
+        def reset():
+            mvf.data = mvf.MotionCtfData(hint_path)
+            mvf.stats = mvf.SummaryStatistics(mvf.columns_of_interest)
+
+        def run():
+            payload = json.dumps(mvf.progress_updater(0), cls=plotly.utils.PlotlyJSONEncoder)
+            return {'payload_bytes': len(payload.encode())}
+        results['progress_updater[{:d}]'.format(rows)] = measure(run, repeats, setup=reset)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Print the change of every benchmark relative to `baseline_path`
+
+    Returns
+    -------
+    list of str
+        The names of benchmarks that got slower by more than a factor of `threshold`
+    """
+    with open(baseline_path, 'r') as fh:
+        baseline = json.load(fh)
+    regressions = []
+    print("\n{:45s} {:>12s} {:>12s} {:>8s}".format('benchmark', 'baseline (s)', 'current (s)', 'ratio'))
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name, {})
+        if 'seconds' not in result or 'seconds' not in old:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        flag = ' <-- regression' if ratio > threshold else ''
+        print("{:45s} {:12.4f} {:12.4f} {:8.2f}{}".format(name, old['seconds'], result['seconds'], ratio, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mvf on synthetic data",
+                                     epilog="https://github.com/fullerjamesr/mvf")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 50000],
+                        help="Micrographs table sizes (rows) to benchmark the web server with")
+    parser.add_argument("--detector", choices=sorted(synthetic.DETECTORS), default='k3',
+                        help="Detector whose micrograph size to simulate")
+    parser.add_argument("--images", type=int, default=8,
+                        help="Number of micrographs processed by the full watcher benchmark")
+    parser.add_argument("--j", type=int, default=4, help="Threads used by the full watcher benchmark")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--skip", nargs='*', default=[], choices=['images', 'watcher', 'tables', 'progress_updater'],
+                        help="Benchmark groups to skip")
+    parser.add_argument("--work_dir", default=None,
+                        help="Directory for the synthetic data (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--output", default=None,
+                        help="Results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="A previous results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Slow-down ratio reported as a regression by --compare (default: 1.2)")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='mvf_bench_')
+    os.environ['PATH'] = SCRIPTS_DIR + os.pathsep + os.environ.get('PATH', '')
+    results = {}
+    try:
+        if 'images' not in args.skip:
+            results.update(bench_images(work_dir, args.detector, args.repeats))
+        if 'watcher' not in args.skip:
+            results.update(bench_watcher(work_dir, args.detector, args.images, args.repeats, args.j))
+        if 'tables' not in args.skip or 'progress_updater' not in args.skip:
+            # The progress_updater benchmark reuses the tables written here
+            table_results = bench_tables(work_dir, args.sizes, args.repeats)
+            if 'tables' not in args.skip:
+                results.update(table_results)
+        if 'progress_updater' not in args.skip:
+            results.update(bench_progress_updater(work_dir, args.sizes, args.repeats))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {'meta': {'commit': commit, 'time': time.time(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                       'detector': args.detector, 'sizes': args.sizes, 'images': args.images, 'threads': args.j},
+              'results': results}
+    output_path = args.output or os.path.join(REPO_DIR, 'benchmarks', 'results', '{}.json'.format(commit or 'unknown'))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as fh:
+        json.dump(output, fh, indent=2)
+
+    for name, result in results.items():
+        if 'skipped' in result:
+            print("{:45s} skipped: {}".format(name, result['skipped']))
+        else:
+            print("{:45s} {:10.4f} s{}".format(name, result['seconds'],
+                                               "  ({:d} bytes)".format(result['payload_bytes'])
+                                               if 'payload_bytes' in result else ""))
+    print("\nResults written to {}".format(output_path))
+
+    if args.compare and compare(output, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Generate a synthetic Relion/mvf project for benchmarking: MotionCorr and CtfFind STAR files of arbitrary length, plus
+detector-sized micrographs, CTFFind power spectra and _avrot.txt plots for the first few rows.
+
+The layout mimics a real project (compare testing/External/job004):
+
+    MotionCorr/job002/corrected_micrographs.star
+    MotionCorr/job002/Micrographs/<name>.mrc
+    CtfFind/job003/micrographs_ctf.star
+    CtfFind/job003/Micrographs/<name>_noDW.ctf, <name>_noDW.txt, <name>_noDW_avrot.txt
+    External/job004/
+"""
+
+import os
+
+import mrcfile
+import numpy as np
+
+
+# (width, height) of the detectors' output in counting mode
+DETECTORS = {'k3': (5760, 4092),
+             'falcon4': (4096, 4096),
+             'k2': (3838, 3710)}
+FFT_SIZE = 512
+
+MOCO_DIR = os.path.join('MotionCorr', 'job002')
+CTF_DIR = os.path.join('CtfFind', 'job003')
+EXTERNAL_DIR = os.path.join('External', 'job004')
+
+OPTICS_BLOCK = """
+# version 30001
+
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+_rlnMicrographOriginalPixelSize #3
+_rlnVoltage #4
+_rlnSphericalAberration #5
+_rlnAmplitudeContrast #6
+_rlnMicrographPixelSize #7
+opticsGroup1            1     0.530000   300.000000     2.700000     0.100000     1.060000
+
+"""
+
+
+def micrograph_name(i):
+    return 'SYN_{:06d}'.format(i)
+
+
+def _write_loop(fh, block_name, labels, rows):
+    fh.write("\n# version 30001\n\ndata_{}\n\nloop_\n".format(block_name))
+    for i, label in enumerate(labels):
+        fh.write("_{} #{:d}\n".format(label, i + 1))
+    fh.writelines(rows)
+    fh.write("\n")
+
+
+def _synthetic_values(rows, seed):
+    rng = np.random.default_rng(seed)
+    early = rng.gamma(2.0, 0.5, rows)
+    late = rng.gamma(6.0, 1.8, rows)
+    defocus_u = rng.uniform(8000.0, 25000.0, rows)
+    astigmatism = rng.gamma(2.0, 150.0, rows)
+    return {'early': early, 'late': late, 'total': early + late, 'defocus_u': defocus_u,
+            'defocus_v': defocus_u - astigmatism, 'astigmatism': astigmatism,
+            'angle': rng.uniform(-90.0, 90.0, rows), 'fom': rng.uniform(0.01, 0.05, rows),
+            'max_res': 2.8 + rng.gamma(2.0, 0.4, rows)}
+
+
+def _paths(i):
+    name = micrograph_name(i)
+    return {'mic': os.path.join(MOCO_DIR, 'Micrographs', name + '.mrc'),
+            'mic_nodw': os.path.join(MOCO_DIR, 'Micrographs', name + '_noDW.mrc'),
+            'metadata': os.path.join(MOCO_DIR, 'Micrographs', name + '.star'),
+            'ctf_image': os.path.join(CTF_DIR, 'Micrographs', name + '_noDW.ctf:mrc')}
+
+
+MOCO_FORMAT = "{mic_nodw} {mic} {group:12d} {metadata} {total:12.6f} {early:12.6f} {late:12.6f}\n"
+CTF_FORMAT = ("{mic_nodw} {mic} {group:12d} {ctf_image} {defocus_u:12.6f} {defocus_v:12.6f} {astigmatism:12.6f} "
+              "{angle:12.5f} {fom:12.6f} {max_res:12.6f}")
+MOCO_LABELS = ['rlnMicrographNameNoDW', 'rlnMicrographName', 'rlnOpticsGroup', 'rlnMicrographMetadata',
+               'rlnAccumMotionTotal', 'rlnAccumMotionEarly', 'rlnAccumMotionLate']
+CTF_LABELS = ['rlnMicrographNameNoDW', 'rlnMicrographName', 'rlnOpticsGroup', 'rlnCtfImage', 'rlnDefocusU',
+              'rlnDefocusV', 'rlnCtfAstigmatism', 'rlnDefocusAngle', 'rlnCtfFigureOfMerit', 'rlnCtfMaxResolution']
+
+
+def _rows(rows, seed, line_format):
+    values = _synthetic_values(rows, seed)
+    for i in range(rows):
+        fields = {k: v[i] for k, v in values.items()}
+        fields.update(_paths(i))
+        yield line_format.format(group=1, **fields)
+
+
+def write_star_files(project_dir, rows, seed=0):
+    """
+    Write MotionCorr and CtfFind output STAR files with `rows` micrographs, with realistic-looking values
+
+    Parameters
+    ----------
+    project_dir : str or os.PathLike
+    rows : int
+    seed : int, optional
+
+    Returns
+    -------
+    str
+        The path to the CtfFind micrographs_ctf.star, relative to `project_dir`
+    """
+    for d in (MOCO_DIR, CTF_DIR):
+        os.makedirs(os.path.join(project_dir, d, 'Micrographs'), exist_ok=True)
+    os.makedirs(os.path.join(project_dir, EXTERNAL_DIR), exist_ok=True)
+
+    with open(os.path.join(project_dir, MOCO_DIR, 'corrected_micrographs.star'), 'w') as fh:
+        fh.write(OPTICS_BLOCK)
+        _write_loop(fh, 'micrographs', MOCO_LABELS, _rows(rows, seed, MOCO_FORMAT))
+    ctf_star = os.path.join(CTF_DIR, 'micrographs_ctf.star')
+    with open(os.path.join(project_dir, ctf_star), 'w') as fh:
+        fh.write(OPTICS_BLOCK)
+        _write_loop(fh, 'micrographs', CTF_LABELS, _rows(rows, seed, CTF_FORMAT + "\n"))
+    return ctf_star
+
+
+def write_consolidated_star(project_dir, rows, seed=0):
+    """
+    Write the consolidated External/job004/micrographs.star and .mvf_progress_hint that the progress watcher would
+    produce for `rows` micrographs, as read by the mvf app
+
+    Returns
+    -------
+    str
+        The path to the .mvf_progress_hint file
+    """
+    os.makedirs(os.path.join(project_dir, EXTERNAL_DIR), exist_ok=True)
+    output_path = os.path.join(EXTERNAL_DIR, 'micrographs.star')
+    with open(os.path.join(project_dir, output_path), 'w') as fh:
+        fh.write(OPTICS_BLOCK)
+        _write_loop(fh, 'micrographs', CTF_LABELS + MOCO_LABELS[3:],
+                    _rows(rows, seed, CTF_FORMAT + " {metadata} {total:12.6f} {early:12.6f} {late:12.6f}\n"))
+    hint_path = os.path.join(project_dir, '.mvf_progress_hint')
+    with open(hint_path, 'w') as fh:
+        fh.write("{} {:d}\n".format(output_path, rows))
+    return hint_path
+
+
+def write_micrograph(path, detector='k3', seed=0):
+    """
+    Write a float32 micrograph of the given detector's size: Gaussian noise on a slowly varying background
+    """
+    width, height = DETECTORS[detector]
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((height, width), dtype=np.float32)
+    data += np.linspace(0.0, 0.5, width, dtype=np.float32)[np.newaxis, :]
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = 1.06
+
+
+def write_ctf_outputs(base_path, seed=0):
+    """
+    Write the files CTFFind produces for one micrograph: `base_path`.ctf (power spectrum and fit, written as a
+    single-section stack as CTFFind does), `base_path`.txt (fit summary) and `base_path`_avrot.txt (1D profiles)
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[-FFT_SIZE // 2:FFT_SIZE // 2, -FFT_SIZE // 2:FFT_SIZE // 2].astype(np.float32)
+    r2 = (x * x + y * y) / (FFT_SIZE * FFT_SIZE / 4.0)
+    spectrum = (np.sin(40.0 * r2) ** 2 + 0.3 * rng.standard_normal((FFT_SIZE, FFT_SIZE))).astype(np.float32)
+    with mrcfile.new(base_path + '.ctf', overwrite=True) as mrc:
+        mrc.set_data(spectrum[np.newaxis, :, :])
+
+    with open(base_path + '.txt', 'w') as fh:
+        fh.write("# Output from CTFFind version 4.1.14 (synthetic)\n"
+                 "# Columns: #1 - micrograph number; #2 - defocus 1 [Angstroms]; #3 - defocus 2; #4 - azimuth of "
+                 "astigmatism; #5 - additional phase shift [radians]; #6 - cross correlation; #7 - spacing (in "
+                 "Angstroms) up to which CTF rings were fit successfully\n"
+                 "1.000000 22890.455078 22101.833984 -24.847200 0.000000 0.020986 3.512549\n")
+
+    points = 400
+    freq = np.linspace(0.0, 0.47, points)
+    rotavg = np.exp(-8.0 * freq) + 0.05 * rng.standard_normal(points)
+    fit = np.sin(300.0 * freq ** 2) ** 2
+    quality = np.clip(1.0 - 2.0 * freq, 0.0, 1.0)
+    with open(base_path + '_avrot.txt', 'w') as fh:
+        fh.write("# Output from CTFFind version 4.1.14 (synthetic)\n"
+                 "# Input file: {}.mrc ; Number of micrographs: 1\n"
+                 "# Pixel size: 1.060 Angstroms ; acceleration voltage: 300.0 keV ; spherical aberration: 2.70 mm ; "
+                 "amplitude contrast: 0.10\n"
+                 "# 6 lines per micrograph: #1 - spatial frequency (1/Angstroms); #2 - 1D rotational average of "
+                 "spectrum (assuming no astigmatism); #3 - 1D rotational average of spectrum; #4 - CTF fit; #5 - "
+                 "cross-correlation between spectrum and CTF fit; #6 - 2sigma of expected cross correlation of noise"
+                 "\n".format(os.path.basename(base_path)))
+        for line in (freq, rotavg, rotavg, fit, quality, np.full(points, 0.1)):
+            fh.write(" ".join("{:.6f}".format(v) for v in line) + "\n")
+
+
+def write_images(project_dir, count, detector='k3'):
+    """
+    Write the micrographs and CTFFind outputs referenced by the first `count` rows of the STAR files
+    """
+    for i in range(count):
+        name = micrograph_name(i)
+        write_micrograph(os.path.join(project_dir, MOCO_DIR, 'Micrographs', name + '.mrc'), detector, seed=i)
+        write_ctf_outputs(os.path.join(project_dir, CTF_DIR, 'Micrographs', name + '_noDW'), seed=i)
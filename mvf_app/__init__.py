@@ -0,0 +1,4 @@
+import time
+
+# When the package (and so the mvf app with its Dash/plotly imports) started loading, for the startup timings
+import_started = time.perf_counter()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 import os
+import threading
+import time
+from collections import ChainMap, OrderedDict
 
 import flask
 import dash
@@ -10,7 +13,10 @@ import dash_table
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
-from .data import MotionCtfData
+from . import export, import_started, metrics
+from .data import MotionCtfData, PreviewMetrics
+from .selection import THRESHOLDS_FILENAME, IncrementalSelection, SelectionThresholds, read_thresholds, write_thresholds
+from .stats import SummaryStatistics
 
 
 ####
@@ -20,7 +26,19 @@ from .data import MotionCtfData
 
 # The object holding and monitoring the Relion job output
 data = None
-from .components import columns_of_interest, overview_figure, motion_figure, ctf_figure, update_figures
+# Preview generation throughput reported by the progress watcher
+preview_metrics = None
+# Incrementally updated summaries of `data`, used for the rolling overlays and the summary panel. Callbacks run
+# concurrently on the threaded server, so new rows are folded in (and the results read) under `stats_lock`.
+stats = None
+stats_lock = threading.Lock()
+# Micrographs passing the selection thresholds, which are shared with the progress watcher through `thresholds_path`
+selection = None
+selection_lock = threading.Lock()
+thresholds_path = None
+# Seconds spent in each phase of server startup, so that regressions in startup time are visible
+startup_timings = OrderedDict()
+from .components import columns_of_interest, columns_text_map, get_figures, update_figures
 
 
 ####
@@ -40,8 +58,19 @@ details_table = dash_table.DataTable(id='details_table',
                                      fixed_rows={'headers': True, 'data': 0},
                                      style_table={'margin-top': '20px', 'margin-bottom': '20px', 'maxHeight': '40vh',
                                                   'overflowY': 'scroll'})
+summary_table = dash_table.DataTable(id='summary_table',
+                                     style_table={'margin-top': '10px', 'margin-bottom': '10px', 'overflowX': 'auto'},
+                                     style_cell={'textAlign': 'right'},
+                                     style_cell_conditional=[{'if': {'column_id': 'column'}, 'textAlign': 'left'}])
+selection_labels = {'max_resolution': 'Max. CTF fit resolution (Å)',
+                    'max_motion': 'Max. total motion (Å)',
+                    'min_defocus': 'Min. defocus (Å)',
+                    'max_defocus': 'Max. defocus (Å)'}
+threshold_inputs = OrderedDict((field, dcc.Input(id='threshold_{}'.format(field), type='number', debounce=True,
+                                                 placeholder='none'))
+                               for field in SelectionThresholds.fields)
 project_name_header = html.H4(className="headerItem")
-app.layout = html.Div([
+page_layout = html.Div([
                 html.Div(id="header", children=[
                     html.H4(className="headerItem", children='mvf: Live Relion Preprocessing'),
                     project_name_header,
@@ -50,8 +79,22 @@ app.layout = html.Div([
                 dcc.Tabs([
                     dcc.Tab(label='Overview', style=tab_style_fix, selected_style=tab_style_fix, children=[
                         html.Div([
-                            dcc.Graph(id='overview_figure', figure=overview_figure, style={'height': '100vh'}),
-                            html.H6(id='mic_counter', children='Total processed micrographs: 0')
+                            dcc.Graph(id='overview_figure', style={'height': '100vh'}),
+                            html.H6(id='mic_counter', children='Total processed micrographs: 0'),
+                            html.H6(id='preview_throughput')
+                        ]),
+                        html.Div(style={'border-top': '2px solid #1975FA', 'margin-top': '5vh'}, children=[
+                            html.H6('Summary statistics:'),
+                            summary_table
+                        ]),
+                        html.Div(style={'border-top': '2px solid #1975FA', 'margin-top': '5vh'}, children=[
+                            html.H6('Micrograph selection for downstream processing:'),
+                            html.Div(className='selection-container', children=[
+                                html.Div(className='selection-member', children=[
+                                    html.Label(selection_labels[field], htmlFor=threshold_input.id), threshold_input
+                                ]) for field, threshold_input in threshold_inputs.items()
+                            ]),
+                            html.H6(id='selection_summary')
                         ]),
                         html.Div(style={'border-top': '2px solid #1975FA', 'margin-top': '5vh'}, children=[
                             html.H6('Most recent processed image:')
@@ -65,9 +108,9 @@ app.layout = html.Div([
                         ])
                     ]),
                     dcc.Tab(label='Motion', style=tab_style_fix, selected_style=tab_style_fix, children=[
-                        dcc.Graph(id='motion_figure', figure=motion_figure, style={'height': '90vh'})]),
+                        dcc.Graph(id='motion_figure', style={'height': '90vh'})]),
                     dcc.Tab(label='CTF', style=tab_style_fix, selected_style=tab_style_fix, children=[
-                        dcc.Graph(id='ctf_figure', figure=ctf_figure, style={'height': '120vh'})]),
+                        dcc.Graph(id='ctf_figure', style={'height': '120vh'})]),
                     dcc.Tab(label='Details', style=tab_style_fix, selected_style=tab_style_fix, children=[
                         html.Div([details_table]),
                         html.Div([
@@ -95,6 +138,20 @@ app.layout = html.Div([
                 refresh_trigger])
 
 
+def serve_layout():
+    """
+    The layout, built on each page load so that the threshold inputs show the thresholds currently saved, rather than
+    those saved when the server started
+    """
+    thresholds = (read_thresholds(thresholds_path) if thresholds_path else None) or SelectionThresholds()
+    for field, threshold_input in threshold_inputs.items():
+        threshold_input.value = getattr(thresholds, field)
+    return page_layout
+
+
+app.layout = serve_layout
+
+
 ####
 #
 # Image handling
@@ -124,11 +181,95 @@ def serve_image(image_path):
     if data and data.data:
         image_filename = '{}.png'.format(image_path)
         project_img_path = os.path.join(os.path.dirname(data.path), 'Previews')
-        return flask.send_from_directory(project_img_path, image_filename)
+        started = time.perf_counter()
+        response = flask.send_from_directory(project_img_path, image_filename)
+        # The file is read as the response is streamed, so time that too
+        response.response = metrics.TimedBody(response.response, 'serve_image', time.perf_counter() - started)
+        return response
     else:
         flask.abort(404)
 
 
+####
+#
+# Bulk export
+#
+@app.server.route('/export/micrographs.<fmt>')
+def export_micrographs(fmt):
+    """
+    Export the loaded micrographs table as CSV (streamed in chunks), an Arrow IPC stream or Parquet.
+
+    Query parameters:
+     * `since=N`: only export rows N onward, for incremental polling
+     * `columns=a,b,c`: only export these columns (default: all)
+    The total row count is returned in the `X-MVF-Row-Count` header, to be used as the next `since`.
+    """
+    if fmt not in export.EXPORT_FORMATS:
+        flask.abort(404)
+    if not export.format_available(fmt):
+        flask.abort(501, description="Export format '{}' requires pyarrow to be installed".format(fmt))
+    # Pick up any new rows first: the table is otherwise only refreshed by `progress_updater`, so a poller talking to
+    # a worker that no browser polls would see the rows loaded at startup. This only reads the hint file if nothing
+    # changed.
+    if data:
+        data.update()
+    # Hold a reference to the current table, since `data.update` may replace it while this response is streaming
+    table = data.data if data else None
+    if not table:
+        flask.abort(404)
+    columns = list(table.keys())
+    if flask.request.args.get('columns'):
+        columns = flask.request.args['columns'].split(',')
+        if any(col not in table for col in columns):
+            flask.abort(400, description="Unknown column requested")
+    try:
+        since = int(flask.request.args.get('since', 0))
+    except ValueError:
+        flask.abort(400, description="'since' must be an integer")
+    if since < 0:
+        flask.abort(400, description="'since' must not be negative")
+
+    mimetype = export.EXPORT_FORMATS[fmt][0]
+    headers = {'X-MVF-Row-Count': str(len(table[columns[0]]))}
+    if fmt == 'csv':
+        return flask.Response(export.iter_csv(table, columns, since), mimetype=mimetype, headers=headers)
+    elif fmt == 'arrow':
+        return flask.Response(export.to_arrow_ipc(table, columns, since), mimetype=mimetype, headers=headers)
+    else:
+        return flask.Response(export.to_parquet(table, columns, since), mimetype=mimetype, headers=headers)
+
+
+####
+#
+# Instrumentation
+#
+@app.server.before_request
+def start_request_timer():
+    flask.g.mvf_request_started = time.perf_counter()
+
+
+@app.server.after_request
+def record_request_metrics(response):
+    route = flask.request.url_rule.rule if flask.request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - flask.g.get('mvf_request_started', time.perf_counter())
+    metrics.requests_total.inc(route=route, status=response.status_code)
+    metrics.request_seconds.observe(elapsed, route=route)
+    callback = flask.g.get('mvf_callback', '')
+    # Streamed responses (e.g. CSV export) have no length known up front
+    if response.content_length is not None:
+        metrics.response_bytes.observe(response.content_length, route=route, callback=callback)
+    # For Dash callback requests, whatever wasn't spent in the callback itself went to request parsing, dispatch and
+    # JSON serialization of the outputs
+    if 'mvf_callback_seconds' in flask.g:
+        metrics.dispatch_seconds.observe(max(elapsed - flask.g.mvf_callback_seconds, 0.0), callback=callback)
+    return response
+
+
+@app.server.route('/metrics')
+def serve_metrics():
+    return flask.Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 ####
 #
 # Callbacks
@@ -139,49 +280,108 @@ def serve_image(image_path):
                Output('ctf_figure', 'figure'),
                Output('overview_real', 'src'),
                Output('overview_fft', 'src'),
-               Output('details_table', 'data')],
+               Output('details_table', 'data'),
+               Output('summary_table', 'data'),
+               Output('preview_throughput', 'children')],
               [Input('interval-component', 'n_intervals')])
+@metrics.instrument_callback('progress_updater')
 def progress_updater(n_intervals):
-    global data
+    global data, stats, preview_metrics
+    if data:
+        with metrics.timed('data_update'):
+            updated = data.update()
     # Update either because the data changed or this is the first interval fired after load/refresh
-    if data and (data.update() or n_intervals == 0) and data.data:
+    if data and (updated or n_intervals == 0) and data.data:
         # Micrograph counter
         new_count = len(data.data[next(iter(data.data))])
         new_count_str = "Total processed micrographs: {}".format(new_count)
 
-        # Update all graphs
-        update_figures(data.data)
+        # Fold any new rows into the running statistics, then update all graphs including the derived overlays
+        with stats_lock:
+            with metrics.timed('stats_update'):
+                stats.update(data.data, data.data_file)
+            with metrics.timed('update_figures'):
+                overview_figure, motion_figure, ctf_figure = update_figures(ChainMap(data.data, stats.overlays))
+            summary_rows = stats.summary_rows(columns_text_map)
+
+        # Preview generation rate and backlog, as last reported by the progress watcher
+        preview_metrics.update()
+        throughput = preview_metrics.micrographs_per_minute()
+        if throughput is None:
+            preview_throughput_str = "Preview generation: no recent runs"
+        else:
+            preview_throughput_str = "Preview generation: {:.1f} micrographs/min ({:.1f} while rendering)".format(
+                preview_metrics.wall_clock_micrographs_per_minute(), throughput)
+            if preview_metrics.backlog is not None:
+                preview_throughput_str += ", backlog: {:d} micrographs".format(preview_metrics.backlog)
+            if preview_metrics.failures:
+                preview_throughput_str += " ({:d} failed tasks)".format(preview_metrics.failures)
 
         # Update Overview tab most recent images
         overview_micrograph_src = generate_mic_image_src(-1)
         overview_fft_src = generate_fft_image_src(-1)
 
         # Datatable contents
-        datatable_contents = data.to_datatable_format(columns_of_interest)
+        with metrics.timed('to_datatable_format'):
+            datatable_contents = data.to_datatable_format(columns_of_interest)
 
         return new_count_str, overview_figure, motion_figure, ctf_figure, overview_micrograph_src, overview_fft_src,\
-               datatable_contents
+               datatable_contents, summary_rows, preview_throughput_str
     else:
         raise PreventUpdate
 
 
+@app.callback(Output('selection_summary', 'children'),
+              [Input(threshold_input.id, 'value') for threshold_input in threshold_inputs.values()] +
+              [Input('mic_counter', 'children')])
+@metrics.instrument_callback('selection_updater')
+def selection_updater(*values):
+    global data, selection
+    if data is None or selection is None or not data.data:
+        raise PreventUpdate
+    # Edits to the thresholds are saved for the progress watcher to apply on its next run. The selection is always
+    # evaluated against the saved thresholds, so that a client still showing older values (e.g. a tab opened before
+    # another client's edit) doesn't switch the shared selection back to them on every refresh.
+    thresholds = read_thresholds(thresholds_path) or SelectionThresholds()
+    if any(t['prop_id'].startswith('threshold_') for t in dash.callback_context.triggered):
+        edited = SelectionThresholds.from_dict(dict(zip(threshold_inputs, values)))
+        if edited != thresholds:
+            write_thresholds(thresholds_path, edited)
+            thresholds = edited
+    with selection_lock:
+        selection.set_thresholds(thresholds)
+        selection.update(data.data)
+        accepted, row_count, accept_rate = selection.accepted, selection.row_count, selection.accept_rate
+    if not thresholds.active:
+        return "No selection thresholds set: all {:d} micrographs are selected".format(row_count)
+    return "Selected: {:d} of {:d} micrographs ({:.1%})".format(accepted, row_count, accept_rate)
+
+
 @app.callback([Output('details_table', 'style_data_conditional'),
                Output('details_real', 'src'),
                Output('details_fft', 'src'),
                Output('details_avrot', 'src'),
                Output('interval-component', 'n_intervals')],
               [Input('details_table', 'selected_rows')])
+@metrics.instrument_callback('row_selected_updater')
 def row_selected_updater(selected_rows):
-    # Guard against callback sequence not having anything in `data.data` yet
     global data
-    if data is None or data.data is None:
+    if data is None:
         raise PreventUpdate
+    # Reset the interval-component (see below) if this has to wait for the background load at startup, since the
+    # first `progress_updater` may have found nothing to show
+    interval_reset = False
+    if data.data is None:
+        data.update()
+        if data.data is None:
+            raise PreventUpdate
+        interval_reset = True
 
     # Note that, unlike plotly, Dash indices do start at 0
     new_selector = [{'if': {'row_index': i}, 'background_color': '#D2F3FF'} for i in selected_rows]
     # Try first without triggering a massive update, but if this worker hasn't updated, then fire the interval-component
     # by resetting it to 0 so that new info from `data.update` can be synced to all components
-    interval_state = dash.no_update if dash.callback_context.triggered else 0
+    interval_state = dash.no_update if dash.callback_context.triggered and not interval_reset else 0
     try:
         details_real_src = generate_mic_image_src(selected_rows[0])
         details_fft_src = generate_fft_image_src(selected_rows[0])
@@ -204,6 +404,7 @@ def row_selected_updater(selected_rows):
               [State('overview_real', 'src'),
                State('overview_fft', 'src'),
                State('overview_modal', 'style')])
+@metrics.instrument_callback('overview_modal_on')
 def overview_modal_on(overview_mic_clicks, overview_fft_clicks,
                       overview_mic_src, overview_fft_src, modal_container_style):
     if modal_container_style is None:
@@ -225,6 +426,7 @@ def overview_modal_on(overview_mic_clicks, overview_fft_clicks,
                State('details_fft', 'src'),
                State('details_avrot', 'src'),
                State('details_modal', 'style')])
+@metrics.instrument_callback('details_modal_on')
 def details_modal_on(details_mic_clicks, details_fft_clicks, details_avrot_clicks,
                      details_mic_src, details_fft_src, details_avrot_src, container_style):
     if container_style is None:
@@ -246,6 +448,7 @@ def details_modal_on(details_mic_clicks, details_fft_clicks, details_avrot_click
 @app.callback([Output('overview_real', 'n_clicks'),
                Output('overview_fft', 'n_clicks')],
               [Input('overview_modal', 'n_clicks')])
+@metrics.instrument_callback('close_overview_modal')
 def close_overview_modal(n):
     return 0, 0
 
@@ -254,6 +457,7 @@ def close_overview_modal(n):
                Output('details_fft', 'n_clicks'),
                Output('details_avrot', 'n_clicks')],
               [Input('details_modal', 'n_clicks')])
+@metrics.instrument_callback('close_details_modal')
 def close_details_modal(n):
     return 0, 0, 0
 
@@ -267,16 +471,46 @@ def close_details_modal(n):
 server = app.server
 
 
+def log_startup_timing(phase, started):
+    startup_timings[phase] = time.perf_counter() - started
+    metrics.startup_seconds.set(startup_timings[phase], phase=phase)
+    app.server.logger.info("mvf startup: %s took %.3f s", phase, startup_timings[phase])
+
+
 def main(opts=os.environ):
-    global app, data
+    global app, data, stats, preview_metrics, selection, thresholds_path
+    main_started = time.perf_counter()
+    startup_timings['import'] = main_started - import_started
+    metrics.startup_seconds.set(startup_timings['import'], phase='import')
     project_dir = opts.get('MVF_PROJECT_DIR', os.getcwd())
     cfreq = int(opts.get('MVF_CFREQ', 10))
+    stats_window = int(opts.get('MVF_STATS_WINDOW', 50))
+    eager_figures = str(opts.get('MVF_EAGER_FIGURES', '')).lower() in ('1', 'true', 'yes')
+    # Keep cProfile dumps of the slowest callback invocations here, if requested
+    if opts.get('MVF_PROFILE_DIR'):
+        metrics.enable_profiling(opts['MVF_PROFILE_DIR'], keep=int(opts.get('MVF_PROFILE_KEEP', 5)))
     hint_file_path = os.path.join(os.path.abspath(project_dir), '.mvf_progress_hint')
-    data = MotionCtfData(hint_file_path)
+    # Parse the project's .star file in the background rather than holding up import (and every worker boot) for it;
+    # the first `progress_updater` call waits on the same lock if the load hasn't finished yet
+    data = MotionCtfData(hint_file_path, init=False)
+    data_load_started = time.perf_counter()
+    data.update_in_background(callback=lambda: log_startup_timing('data load', data_load_started))
+    stats = SummaryStatistics(columns_of_interest, window=stats_window)
+    preview_metrics = PreviewMetrics(os.path.join(os.path.abspath(project_dir), '.mvf_progress_metrics'))
+    summary_table.columns = stats.summary_table_columns()
+    thresholds_path = os.path.join(os.path.abspath(project_dir), THRESHOLDS_FILENAME)
+    selection = IncrementalSelection(read_thresholds(thresholds_path))
     refresh_trigger.interval = 1000 * cfreq
     project_name_str = os.path.split(project_dir)[-1]
     app.title = "mvf: {:s}".format(project_name_str)
     project_name_header.children = "Project: {:s}".format(project_name_str)
+    # When importing once before forking workers (e.g. `gunicorn --preload`), build the figures here so every worker
+    # inherits them instead of building its own on first use
+    if eager_figures:
+        figures_started = time.perf_counter()
+        get_figures()
+        log_startup_timing('figures', figures_started)
+    log_startup_timing('main', main_started)
 
 
 if __name__ == '__main__':
@@ -285,10 +519,19 @@ if __name__ == '__main__':
                                      epilog="https://github.com/fullerjamesr/mvf")
     parser.add_argument("--cfreq", default=10, type=int,
                         help="Frequency in seconds to direct clients to poll server (default: 10")
+    parser.add_argument("--stats_window", default=50, type=int,
+                        help="Number of most recent exposures used for rolling statistics (default: 50)")
+    parser.add_argument("--eager_figures", action="store_true",
+                        help="Build the plotly figures at startup rather than on first use")
+    parser.add_argument("--profile_dir", default=None,
+                        help="Profile Dash callbacks and keep cProfile dumps of the slowest calls in this directory")
     parser.add_argument("project_dir", nargs='?',
                         help="The Relion/MVF project directory to be served", default=os.getcwd())
     args = parser.parse_args()
-    cli_opts = {'MVF_PROJECT_DIR': args.project_dir, 'MVF_CFREQ': args.cfreq}
+    cli_opts = {'MVF_PROJECT_DIR': args.project_dir, 'MVF_CFREQ': args.cfreq, 'MVF_STATS_WINDOW': args.stats_window,
+                'MVF_EAGER_FIGURES': args.eager_figures}
+    if args.profile_dir:
+        cli_opts['MVF_PROFILE_DIR'] = args.profile_dir
     main(cli_opts)
     app.run_server(debug=True)
 else:
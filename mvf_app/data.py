@@ -1,34 +1,131 @@
+import json
 import os
-import cryoemtools.relionstarparser as rsp
+import threading
+import time
+from collections import deque
+
+from .starfile import read_star_loop
 
 
 class MotionCtfData:
-    def __init__(self, path, init=True):
+    def __init__(self, path, init=True, columns=None):
         self.path = path
+        # Only load these columns of the micrographs table (default: all)
+        self.columns = columns
         self.data_file = None
         self.data_count = 0
         self.data = None
+        # Serializes `update` between request threads and any background load
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # A lock held by a background load at fork time would otherwise stay locked forever in the child
+            os.register_at_fork(after_in_child=self._reset_lock)
         if init:
             self.update()
 
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
     def update(self):
-        if not os.path.isfile(self.path):
-            return False
-        with open(self.path, 'r') as hint_file:
-            data_file, data_count = hint_file.readline().strip().split()
-            data_file = os.path.join(os.path.dirname(self.path), data_file)
-            data_count = int(data_count)
-        if data_count != self.data_count or data_file != self.data_file:
-            data = rsp.read_star(data_file, block_list=['micrographs'], flatten=True)
-            self.data_file = data_file
-            self.data_count = data_count
-            self.data = data
-            return True
-        else:
-            return False
+        with self._lock:
+            if not os.path.isfile(self.path):
+                return False
+            with open(self.path, 'r') as hint_file:
+                data_file, data_count = hint_file.readline().strip().split()
+                data_file = os.path.join(os.path.dirname(self.path), data_file)
+                data_count = int(data_count)
+            if data_count != self.data_count or data_file != self.data_file:
+                data = read_star_loop(data_file, 'micrographs', columns=self.columns, fallback=True)
+                self.data_file = data_file
+                self.data_count = data_count
+                self.data = data
+                return True
+            else:
+                return False
+
+    def update_in_background(self, callback=None):
+        def load():
+            self.update()
+            if callback:
+                callback()
+        thread = threading.Thread(target=load, name='MotionCtfData.update', daemon=True)
+        thread.start()
+        return thread
 
     def to_datatable_format(self, columns):
         if self.data:
-            return [{col: self.data[col][i] for col in columns} for i in range(len(self.data[columns[0]]))]
+            # Numeric columns are NumPy arrays; `tolist` converts them to native Python values in one call
+            values = [self.data[col].tolist() if hasattr(self.data[col], 'tolist') else self.data[col]
+                      for col in columns]
+            return [dict(zip(columns, row)) for row in zip(*values)]
         else:
             return []
+
+
+class PreviewMetrics:
+    """
+    Follows the JSON lines metrics file written by the progress watcher (`.mvf_progress_metrics`), keeping the most
+    recent run summaries and the latest backlog. Only lines appended since the previous `update` are read, and rotation
+    of the file is detected by a change of inode or a shrinking size.
+    """
+    def __init__(self, path, max_runs=100):
+        self.path = path
+        self.runs = deque(maxlen=max_runs)
+        self.backlog = None
+        self._inode = None
+        self._offset = 0
+
+    def update(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._inode = stat.st_ino
+            self._offset = 0
+        if stat.st_size == self._offset:
+            return False
+        with open(self.path, 'rb') as fh:
+            fh.seek(self._offset)
+            lines = fh.readlines()
+        # Leave any partially written last line for the next update
+        if lines and not lines[-1].endswith(b'\n'):
+            lines.pop()
+        for line in lines:
+            self._offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('type') == 'run':
+                self.runs.append(record)
+            # Detached watcher runs only queue previews, so report the backlog without a run summary
+            if record.get('type') in ('run', 'backlog'):
+                self.backlog = record['backlog']
+        return bool(lines)
+
+    def micrographs_per_minute(self, window=1800):
+        """
+        Preview generation throughput over the runs that finished in the last `window` seconds, counting only the time
+        spent rendering
+        """
+        cutoff = time.time() - window
+        recent = [run for run in self.runs if run['time'] >= cutoff]
+        elapsed = sum(run['elapsed'] for run in recent)
+        return 60.0 * sum(run['micrographs'] for run in recent) / elapsed if elapsed > 0 else None
+
+    def wall_clock_micrographs_per_minute(self, window=1800):
+        """
+        Preview generation throughput over the runs that finished in the last `window` seconds, from the start of the
+        first of them to the end of the last, so including the time between runs
+        """
+        cutoff = time.time() - window
+        recent = [run for run in self.runs if run['time'] >= cutoff]
+        if not recent:
+            return None
+        elapsed = recent[-1]['time'] - recent[0]['started']
+        return 60.0 * sum(run['micrographs'] for run in recent) / elapsed if elapsed > 0 else None
+
+    @property
+    def failures(self):
+        return self.runs[-1]['failures'] if self.runs else None
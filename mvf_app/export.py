@@ -0,0 +1,124 @@
+import csv
+import io
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Format name -> (mimetype, requires pyarrow)
+EXPORT_FORMATS = {'csv': ('text/csv', False),
+                  'arrow': ('application/vnd.apache.arrow.stream', True),
+                  'parquet': ('application/vnd.apache.parquet', True)}
+
+
+def format_available(fmt):
+    """
+    Whether `fmt` is a known export format whose dependencies are installed
+    """
+    return fmt in EXPORT_FORMATS and (pyarrow is not None or not EXPORT_FORMATS[fmt][1])
+
+
+def column_slices(table, columns, since=0):
+    """
+    Views of rows `since` onward of each of `columns` in a flattened (column name -> sequence) table
+
+    Parameters
+    ----------
+    table : dict
+    columns : list of str
+    since : int, optional
+
+    Returns
+    -------
+    list
+        One sequence per requested column, in the same order as `columns`
+    """
+    return [table[col][since:] for col in columns]
+
+
+def iter_csv(table, columns, since=0, chunk_rows=4096):
+    """
+    Generate the CSV encoding of rows `since` onward of `table` in chunks of `chunk_rows` rows, suitable for a streamed
+    (chunked transfer encoding) response. Rows are drawn by zipping the column sequences, so no per-row dict is built.
+
+    Parameters
+    ----------
+    table : dict
+        A flattened (column name -> sequence) table like `MotionCtfData.data`
+    columns : list of str
+        The columns to write, in order
+    since : int, optional
+        The first row to export
+    chunk_rows : int, optional
+        The number of rows encoded into each yielded chunk
+
+    Yields
+    ------
+    str
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    rows = zip(*column_slices(table, columns, since))
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if chunk:
+            writer.writerows(chunk)
+        yield buffer.getvalue()
+        if len(chunk) < chunk_rows:
+            break
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def to_arrow_table(table, columns, since=0):
+    """
+    Build a `pyarrow.Table` of rows `since` onward of `table`, one Arrow array per column
+
+    Parameters
+    ----------
+    table : dict
+    columns : list of str
+    since : int, optional
+
+    Returns
+    -------
+    pyarrow.Table
+    """
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is required for Arrow and Parquet export")
+    return pyarrow.Table.from_arrays([pyarrow.array(c) for c in column_slices(table, columns, since)], names=columns)
+
+
+def to_arrow_ipc(table, columns, since=0):
+    """
+    Encode rows `since` onward of `table` as an Arrow IPC stream
+
+    Returns
+    -------
+    bytes
+    """
+    arrow_table = to_arrow_table(table, columns, since)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return sink.getvalue().to_pybytes()
+
+
+def to_parquet(table, columns, since=0):
+    """
+    Encode rows `since` onward of `table` as a Parquet file
+
+    Returns
+    -------
+    bytes
+    """
+    arrow_table = to_arrow_table(table, columns, since)
+    sink = pyarrow.BufferOutputStream()
+    pyarrow.parquet.write_table(arrow_table, sink)
+    return sink.getvalue().to_pybytes()
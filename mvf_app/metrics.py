@@ -0,0 +1,294 @@
+import cProfile
+import functools
+import heapq
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+from dash.exceptions import PreventUpdate
+
+
+# Bucket upper bounds for latency (seconds) and payload size (bytes) histograms
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ((k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in escaped) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} expects labels {}, got {}".format(self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.metric_type)]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._render_sample(key, self._values[key]))
+        return lines
+
+    def _render_sample(self, key, value):
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket (non-cumulative) counts followed by the running sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def _render_sample(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            bucket_labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append('{}_bucket{} {}'.format(self.name, bucket_labels, cumulative))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(counts[-1])))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """
+    A collection of metrics that can be rendered together in the Prometheus text exposition format
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+####
+#
+# The metrics collected by the mvf server
+#
+registry = Registry()
+requests_total = registry.counter('mvf_http_requests_total', 'HTTP requests handled', ['route', 'status'])
+request_seconds = registry.histogram('mvf_http_request_seconds', 'Wall time to handle an HTTP request', ['route'])
+# `callback` is the Dash callback served by a /_dash-update-component request, and empty for other routes
+response_bytes = registry.histogram('mvf_http_response_bytes', 'HTTP response body size', ['route', 'callback'],
+                                    buckets=BYTES_BUCKETS)
+callback_seconds = registry.histogram('mvf_callback_seconds', 'Wall time spent inside a Dash callback',
+                                      ['callback', 'outcome'])
+stage_seconds = registry.histogram('mvf_stage_seconds', 'Wall time spent in each stage of request handling',
+                                   ['stage'])
+dispatch_seconds = registry.histogram('mvf_dash_dispatch_seconds',
+                                      'Wall time spent handling a Dash callback request outside the callback itself '
+                                      '(request parsing, dispatch and JSON serialization of the outputs)', ['callback'])
+startup_seconds = registry.gauge('mvf_startup_seconds', 'Wall time spent in each phase of server startup', ['phase'])
+
+
+@contextmanager
+def timed(stage):
+    """
+    Context manager recording the wall time of its body in `stage_seconds` under `stage`
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+class TimedBody:
+    """
+    Wraps a response body iterable to record the time spent producing it in `stage_seconds` under `stage` once the
+    server closes it. Needed for responses such as `flask.send_from_directory`, whose file is only read while the body
+    is streamed, after the view function and the request hooks have returned.
+
+    Parameters
+    ----------
+    body : iterable of bytes
+    stage : str
+    elapsed : float, optional
+        Seconds already spent preparing the response, to be added to the total
+    """
+    def __init__(self, body, stage, elapsed=0.0):
+        self.body = body
+        self.stage = stage
+        self.elapsed = elapsed
+        self._recorded = False
+
+    def __iter__(self):
+        chunks = iter(self.body)
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.elapsed += time.perf_counter() - started
+                return
+            self.elapsed += time.perf_counter() - started
+            yield chunk
+
+    def close(self):
+        close = getattr(self.body, 'close', None)
+        if close is not None:
+            close()
+        if not self._recorded:
+            self._recorded = True
+            stage_seconds.observe(self.elapsed, stage=self.stage)
+
+
+class SlowCallProfiler:
+    """
+    Run calls under cProfile and keep the profiles of the `keep` slowest calls per name as .prof files in `directory`,
+    for inspection with `pstats` or snakeviz.
+
+    Parameters
+    ----------
+    directory : str or os.PathLike
+    keep : int, optional
+    """
+    def __init__(self, directory, keep=5):
+        self.directory = directory
+        self.keep = keep
+        self._slowest = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def call(self, name, func, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread or process; run this call unprofiled
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._offer(name, time.perf_counter() - started, profile)
+
+    def _offer(self, name, duration, profile):
+        with self._lock:
+            slowest = self._slowest.setdefault(name, [])
+            if len(slowest) >= self.keep and duration <= slowest[0][0]:
+                return
+            path = os.path.join(self.directory, '{}-{:.0f}ms-{:d}.prof'.format(name, duration * 1000, time.time_ns()))
+            profile.dump_stats(path)
+            if len(slowest) >= self.keep:
+                _, evicted = heapq.heapreplace(slowest, (duration, path))
+                try:
+                    os.remove(evicted)
+                except FileNotFoundError:
+                    pass
+            else:
+                heapq.heappush(slowest, (duration, path))
+
+
+# Set by `enable_profiling`; when None, callbacks are only timed
+profiler = None
+
+
+def enable_profiling(directory, keep=5):
+    global profiler
+    profiler = SlowCallProfiler(directory, keep)
+
+
+def instrument_callback(name):
+    """
+    Decorator recording the wall time and outcome ('ok', 'prevented' or 'error') of a Dash callback in
+    `callback_seconds`, and profiling it if `enable_profiling` has been called. The callback's name and wall time are
+    also left in `flask.g` for the request hooks. Apply beneath `@app.callback`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            outcome = 'ok'
+            started = time.perf_counter()
+            try:
+                if profiler is not None:
+                    return profiler.call(name, func, *args, **kwargs)
+                return func(*args, **kwargs)
+            except PreventUpdate:
+                outcome = 'prevented'
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                callback_seconds.observe(elapsed, callback=name, outcome=outcome)
+                if flask.has_request_context():
+                    flask.g.mvf_callback = name
+                    flask.g.mvf_callback_seconds = elapsed
+        return wrapper
+    return decorator
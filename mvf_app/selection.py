@@ -0,0 +1,172 @@
+"""
+Threshold-based selection of micrographs for downstream processing.
+
+Thresholds are kept in a small JSON file in the project directory (`.mvf_selection_thresholds`), so that they can be
+adjusted from the mvf app while the progress watcher reads them on each run to write `selected_micrographs.star`.
+Masks are computed with vectorized comparisons over only the rows that arrived since the last evaluation.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+THRESHOLDS_FILENAME = '.mvf_selection_thresholds'
+
+
+class SelectionThresholds:
+    """
+    Acceptance criteria for a micrograph. Any threshold left as None is not applied; NaN values are never accepted by
+    an applied threshold.
+
+    Parameters
+    ----------
+    max_resolution : float, optional
+        Maximum (worst) CTF fit resolution, `rlnCtfMaxResolution`, in Å
+    max_motion : float, optional
+        Maximum total whole-frame motion, `rlnAccumMotionTotal`, in Å
+    min_defocus, max_defocus : float, optional
+        Accepted range of `rlnDefocusU`, in Å
+    """
+    fields = ('max_resolution', 'max_motion', 'min_defocus', 'max_defocus')
+
+    def __init__(self, max_resolution=None, max_motion=None, min_defocus=None, max_defocus=None):
+        self.max_resolution = max_resolution
+        self.max_motion = max_motion
+        self.min_defocus = min_defocus
+        self.max_defocus = max_defocus
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{field: None if values.get(field) is None else float(values[field]) for field in cls.fields})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __eq__(self, other):
+        return isinstance(other, SelectionThresholds) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return 'SelectionThresholds({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in self.to_dict().items()))
+
+    @property
+    def active(self):
+        return any(value is not None for value in self.to_dict().values())
+
+    def bounds(self):
+        """
+        The applied thresholds as a list of (column, lower bound or None, upper bound or None)
+        """
+        bounds = [('rlnCtfMaxResolution', None, self.max_resolution),
+                  ('rlnAccumMotionTotal', None, self.max_motion),
+                  ('rlnDefocusU', self.min_defocus, self.max_defocus)]
+        return [(column, lower, upper) for column, lower, upper in bounds if lower is not None or upper is not None]
+
+
+def read_thresholds(path):
+    """
+    Read thresholds written by `write_thresholds`
+
+    Returns
+    -------
+    SelectionThresholds or None
+        None if `path` does not exist or can't be parsed
+    """
+    try:
+        with open(path, 'r') as fh:
+            return SelectionThresholds.from_dict(json.load(fh))
+    except (FileNotFoundError, ValueError, TypeError, AttributeError):
+        return None
+
+
+def write_thresholds(path, thresholds):
+    """
+    Atomically replace the thresholds file at `path`
+    """
+    temp_path = '{}.{:d}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as fh:
+        json.dump(thresholds.to_dict(), fh)
+    os.replace(temp_path, path)
+
+
+def selection_mask(table, thresholds, start=0, stop=None):
+    """
+    Evaluate `thresholds` over rows `start` to `stop` of a column-oriented table
+
+    Parameters
+    ----------
+    table : dict
+        Column name -> sequence of values, which may be numbers or numeric strings
+    thresholds : SelectionThresholds
+    start : int, optional
+    stop : int, optional
+        Default: the end of the table
+
+    Returns
+    -------
+    numpy.ndarray of bool
+    """
+    if stop is None:
+        stop = len(next(iter(table.values()))) if table else 0
+    mask = np.ones(max(stop - start, 0), dtype=bool)
+    for column, lower, upper in thresholds.bounds():
+        values = np.asarray(table[column][start:stop], dtype=np.float64)
+        if lower is not None:
+            mask &= values >= lower
+        if upper is not None:
+            mask &= values <= upper
+    return mask
+
+
+class IncrementalSelection:
+    """
+    Keeps the selection mask of a growing table up to date, evaluating only rows appended since the previous `update`.
+    The mask is recomputed from scratch if the thresholds change or the table shrinks.
+
+    Parameters
+    ----------
+    thresholds : SelectionThresholds, optional
+    """
+    def __init__(self, thresholds=None):
+        self.thresholds = thresholds or SelectionThresholds()
+        self.reset()
+
+    def reset(self):
+        self.row_count = 0
+        self.accepted = 0
+        self._masks = []
+
+    def set_thresholds(self, thresholds):
+        if thresholds != self.thresholds:
+            self.thresholds = thresholds
+            self.reset()
+
+    def update(self, table):
+        """
+        Evaluate any rows of `table` beyond those already seen
+
+        Returns
+        -------
+        numpy.ndarray of bool
+            The mask of the newly evaluated rows
+        """
+        n = len(next(iter(table.values()))) if table else 0
+        if n < self.row_count:
+            self.reset()
+        mask = selection_mask(table, self.thresholds, self.row_count, n)
+        if len(mask):
+            self._masks.append(mask)
+            self.accepted += int(np.count_nonzero(mask))
+            self.row_count = n
+        return mask
+
+    @property
+    def mask(self):
+        if len(self._masks) > 1:
+            self._masks = [np.concatenate(self._masks)]
+        return self._masks[0] if self._masks else np.zeros(0, dtype=bool)
+
+    @property
+    def accept_rate(self):
+        return self.accepted / self.row_count if self.row_count else None
@@ -0,0 +1,222 @@
+"""
+A fast reader and writer for the simple `loop_` tables that make up Relion's micrograph STAR files.
+
+`cryoemtools.relionstarparser.read_star` handles the full STAR syntax but builds its output value by value, which
+dominates the cost of reading a `micrographs` table with tens of thousands of rows. Here each block's data lines are
+tokenized in one `str.split` call and each column is a strided slice of the token list, converted to a NumPy array in
+bulk. Blocks containing quoted values are tokenized line by line with `shlex` instead. Blocks using STAR features this
+doesn't handle (multi-line values, key-value blocks) raise `UnsupportedStarError`, or fall back to `read_star` via
+`read_star_loops(..., fallback=True)`.
+"""
+
+import shlex
+from collections import OrderedDict
+
+import numpy as np
+
+
+class UnsupportedStarError(ValueError):
+    """
+    A STAR block uses syntax that the fast reader does not handle
+    """
+    pass
+
+
+def _block_spans(text):
+    # (name, body start, body end) of each data_ block. Searching with str.find is much faster than a multi-line regex
+    # over a large file.
+    headers = []
+    # Searching for '\ndata_' in '\n' + text also finds a header on the first line; index i of '\ndata_' in `padded` is
+    # the index of 'data_' in `text`
+    padded = '\n' + text
+    header_start = padded.find('\ndata_')
+    while header_start >= 0:
+        header_end = text.find('\n', header_start)
+        if header_end < 0:
+            header_end = len(text)
+        headers.append((header_start, text[header_start + len('data_'):header_end].strip(), header_end))
+        header_start = padded.find('\ndata_', header_end + 1)
+    return [(name, body_start, headers[i + 1][0] if i + 1 < len(headers) else len(text))
+            for i, (_, name, body_start) in enumerate(headers)]
+
+
+def _convert(tokens):
+    # Integers, then floats, then leave as strings: the same precedence as read_star's convert_numeric. Parsing with the
+    # builtin int/float into `np.fromiter` is several times faster than `astype` on an array of str.
+    for parse, dtype in ((int, np.int64), (float, np.float64)):
+        try:
+            return np.fromiter(map(parse, tokens), dtype, len(tokens))
+        except (ValueError, OverflowError):
+            pass
+    return list(tokens)
+
+
+def _parse_loop(block_name, text, columns, convert_numeric):
+    lines = text.splitlines()
+    i = 0
+    # Skip to the loop_ header
+    while i < len(lines) and (not lines[i].strip() or lines[i].lstrip().startswith('#')):
+        i += 1
+    if i == len(lines) or lines[i].strip() != 'loop_':
+        raise UnsupportedStarError("data_{} is not a loop_ block".format(block_name))
+    i += 1
+
+    labels = []
+    while i < len(lines):
+        stripped = lines[i].strip()
+        if stripped.startswith('_'):
+            labels.append(stripped.split()[0][1:])
+        elif stripped and not stripped.startswith('#'):
+            break
+        i += 1
+
+    rows = [line for line in lines[i:] if line.strip() and not line.lstrip().startswith('#')]
+    ncols = len(labels)
+    joined = ' '.join(rows)
+    if '"' in joined or "'" in joined:
+        # Quoted values need unquoting and may contain whitespace; tokenize line by line instead
+        tokens = []
+        for line in rows:
+            try:
+                line_tokens = shlex.split(line, comments=False, posix=True)
+            except ValueError as error:
+                raise UnsupportedStarError("data_{}: {}".format(block_name, error))
+            if len(line_tokens) != ncols:
+                raise UnsupportedStarError("data_{}: row has {:d} values for {:d} columns".format(
+                    block_name, len(line_tokens), ncols))
+            tokens.extend(line_tokens)
+    else:
+        tokens = joined.split()
+        if len(tokens) != len(rows) * ncols:
+            raise UnsupportedStarError("data_{}: {:d} values do not fill {:d} rows of {:d} columns".format(
+                block_name, len(tokens), len(rows), ncols))
+
+    table = OrderedDict()
+    for index, label in enumerate(labels):
+        if columns is not None and label not in columns:
+            continue
+        column_tokens = tokens[index::ncols]
+        table[label] = _convert(column_tokens) if convert_numeric else column_tokens
+    if columns is not None:
+        missing = [col for col in columns if col not in table]
+        if missing:
+            raise KeyError("data_{} has no column(s) {}".format(block_name, ', '.join(missing)))
+    return table
+
+
+def read_star_loops(source, blocks=None, columns=None, convert_numeric=True, fallback=False):
+    """
+    Read `loop_` blocks of a STAR file into column-oriented tables
+
+    Parameters
+    ----------
+    source : str or os.PathLike or file-like
+        The STAR file to read
+    blocks : list of str, optional
+        The names (without the `data_` prefix) of the blocks to read. Blocks not present in the file are silently
+        omitted from the output, as with `read_star`'s `block_list`. Default: every block.
+    columns : list of str, optional
+        Only keep these columns (default: all). A requested column missing from a block raises KeyError.
+    convert_numeric : bool, optional
+        Convert columns whose values are all integers or all numbers to int64 or float64 NumPy arrays. Other columns,
+        and every column when this is False, are lists of str.
+    fallback : bool, optional
+        Read a block that uses syntax not handled here with `cryoemtools.relionstarparser.read_star` instead of raising
+        UnsupportedStarError
+
+    Returns
+    -------
+    OrderedDict
+        Mapping of block name -> OrderedDict of column name -> values
+    """
+    if hasattr(source, 'read'):
+        text = source.read()
+    else:
+        with open(source, 'r') as fh:
+            text = fh.read()
+
+    output = OrderedDict()
+    for block_name, start, end in _block_spans(text):
+        if blocks is not None and block_name not in blocks:
+            continue
+        body = text[start:end]
+        try:
+            output[block_name] = _parse_loop(block_name, body, columns, convert_numeric)
+        except UnsupportedStarError:
+            if not fallback:
+                raise
+            output[block_name] = _read_block_with_rsp(text, block_name, columns, convert_numeric)
+    return output
+
+
+def _read_block_with_rsp(text, block_name, columns, convert_numeric):
+    import io
+    import cryoemtools.relionstarparser as rsp
+    table = rsp.read_star(io.StringIO(text), block_list=[block_name], flatten=True, convert_numeric=convert_numeric)
+    if columns is not None:
+        table = OrderedDict((col, table[col]) for col in columns)
+    return table
+
+
+def read_star_loop(source, block, columns=None, convert_numeric=True, fallback=False):
+    """
+    Read a single `loop_` block of a STAR file; see `read_star_loops`
+
+    Raises
+    ------
+    KeyError
+        If the file has no such block
+    """
+    tables = read_star_loops(source, [block], columns=columns, convert_numeric=convert_numeric, fallback=fallback)
+    if block not in tables:
+        raise KeyError("{} has no data_{} block".format(getattr(source, 'name', source), block))
+    return tables[block]
+
+
+def table_length(table):
+    """
+    The number of rows in a column-oriented table as returned by `read_star_loop`
+    """
+    return len(next(iter(table.values()))) if table else 0
+
+
+def write_star_loop(fh, table, block_name, terminate=True):
+    """
+    Write a column-oriented table (column name -> sequence of values) as a STAR `loop_` block
+
+    Parameters
+    ----------
+    fh : file-like
+    table : dict
+    block_name : str
+        The block name, without the `data_` prefix
+    terminate : bool, optional
+        End the loop with a blank line. Leave the loop open (as the last block of the file) if rows are to be appended
+        to it later with `write_star_rows`.
+    """
+    fh.write("\ndata_{}\n\nloop_ \n".format(block_name))
+    for i, label in enumerate(table):
+        fh.write("_{} #{:d} \n".format(label, i + 1))
+    write_star_rows(fh, table)
+    if terminate:
+        fh.write(" \n")
+
+
+def write_star_rows(fh, table):
+    """
+    Write the rows of a column-oriented table as lines of a STAR `loop_` block. Rows appended to a file only extend its
+    last loop if that loop was written with `terminate=False`: Relion stops reading a loop at the first blank line, so
+    rows appended after one are silently ignored.
+    """
+    columns = [[_format_value(v) for v in values] for values in table.values()]
+    fh.writelines(' '.join(row) + ' \n' for row in zip(*columns))
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        if not value:
+            return '""'
+        return '"{}"'.format(value) if any(c.isspace() for c in value) else value
+    if isinstance(value, (float, np.floating)):
+        return '{:.6f}'.format(value)
+    return str(value)
@@ -0,0 +1,356 @@
+import math
+from bisect import bisect_left, insort
+from collections import deque
+
+
+class RunningMoments:
+    """
+    Running count, mean, variance, minimum and maximum of a stream of values using Welford's algorithm.
+
+    Each call to `push` is O(1) in time and the object uses O(1) memory regardless of how many values it has seen.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def push(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class RollingWindow:
+    """
+    The most recent `size` values of a stream, kept both in arrival order and in sorted order so that the mean and any
+    quantile of the window can be read out without re-scanning it.
+
+    Parameters
+    ----------
+    size : int
+        The number of most recent values to keep
+    """
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("RollingWindow size must be at least 1")
+        self.size = size
+        self._values = deque()
+        self._sorted = []
+        self._sum = 0.0
+
+    def __len__(self):
+        return len(self._values)
+
+    def push(self, value):
+        self._values.append(value)
+        insort(self._sorted, value)
+        self._sum += value
+        if len(self._values) > self.size:
+            old = self._values.popleft()
+            del self._sorted[bisect_left(self._sorted, old)]
+            self._sum -= old
+
+    @property
+    def mean(self):
+        return self._sum / len(self._values) if self._values else math.nan
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+    def quantile(self, p):
+        """
+        Linearly interpolated `p` quantile (0 <= p <= 1) of the values currently in the window
+        """
+        n = len(self._sorted)
+        if n == 0:
+            return math.nan
+        position = p * (n - 1)
+        lower = int(position)
+        upper = min(lower + 1, n - 1)
+        return self._sorted[lower] + (self._sorted[upper] - self._sorted[lower]) * (position - lower)
+
+
+class P2Quantile:
+    """
+    Streaming estimate of a single quantile using the P² algorithm (Jain & Chlamtac, Commun. ACM 28, 1985).
+
+    Only five markers are stored, so each call to `push` is O(1) in time and memory. Until five values have been seen
+    the exact quantile of those values is reported.
+
+    Parameters
+    ----------
+    p : float
+        The quantile to track, between 0 and 1
+    """
+    def __init__(self, p):
+        if not 0.0 <= p <= 1.0:
+            raise ValueError("P2Quantile p must be between 0 and 1")
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1.0, 1.0 + 2.0 * p, 1.0 + 4.0 * p, 3.0 + 2.0 * p, 5.0]
+        self._increments = [0.0, p / 2.0, p, (1.0 + p) / 2.0, 1.0]
+
+    def push(self, value):
+        self.count += 1
+        if self.count <= 5:
+            insort(self._heights, value)
+            return
+
+        q = self._heights
+        n = self._positions
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = bisect_left(q, value, 1, 4) - 1
+            if value == q[k + 1]:
+                k += 1
+            k = min(k, 3)
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # Adjust the three middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self._parabolic(i, d)
+                if not q[i - 1] < candidate < q[i + 1]:
+                    candidate = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = candidate
+                n[i] += d
+
+    def extend(self, values):
+        """
+        Push every item of `values`. An empty estimator is instead seeded directly from the sorted batch, placing the
+        five markers at their desired positions, which is much faster than pushing values one at a time.
+        """
+        if self.count > 0 or len(values) <= 5:
+            for value in values:
+                self.push(value)
+            return
+        ordered = sorted(values)
+        n = len(ordered)
+        fractions = [0.0, self.p / 2.0, self.p, (1.0 + self.p) / 2.0, 1.0]
+        positions = [1 + round((n - 1) * f) for f in fractions]
+        # Marker positions must be strictly increasing integers within [1, n]
+        for i in range(1, 5):
+            positions[i] = max(positions[i], positions[i - 1] + 1)
+        positions[4] = n
+        for i in range(3, -1, -1):
+            positions[i] = min(positions[i], positions[i + 1] - 1)
+        self.count = n
+        self._positions = positions
+        self._heights = [ordered[k - 1] for k in positions]
+        self._desired = [1.0 + (n - 1) * f for f in fractions]
+
+    def _parabolic(self, i, d):
+        q = self._heights
+        n = self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                                                   (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    @property
+    def value(self):
+        if self.count == 0:
+            return math.nan
+        if self.count <= 5:
+            position = self.p * (self.count - 1)
+            lower = int(position)
+            upper = min(lower + 1, self.count - 1)
+            return self._heights[lower] + (self._heights[upper] - self._heights[lower]) * (position - lower)
+        return self._heights[2]
+
+
+class ColumnSummary:
+    """
+    All the incremental statistics kept for a single data column
+
+    Parameters
+    ----------
+    window : int
+        The number of most recent exposures used for the rolling statistics
+    quantiles : iterable of float
+        The quantiles to estimate over every exposure seen
+    """
+    def __init__(self, window, quantiles):
+        self.moments = RunningMoments()
+        self.window = RollingWindow(window)
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+        self.rolling_median = []
+
+    def push(self, value):
+        self.moments.push(value)
+        self.window.push(value)
+        for q in self.quantiles:
+            q.push(value)
+        self.rolling_median.append(self.window.median)
+
+    def extend(self, values):
+        for value in values:
+            self.moments.push(value)
+            self.window.push(value)
+            self.rolling_median.append(self.window.median)
+        for q in self.quantiles:
+            q.extend(values)
+
+
+def quantile_key(scope, p):
+    """
+    The `summary_rows` key for quantile `p` computed over `scope` ('all' or 'recent')
+    """
+    return '{}_p{:g}'.format(scope, p * 100)
+
+
+def _json_number(value):
+    # JSON has no representation for inf/nan, which appear before any data has been seen
+    if isinstance(value, float):
+        return round(value, 4) if math.isfinite(value) else None
+    return value
+
+
+def rolling_median_key(column):
+    """
+    The name under which `SummaryStatistics.overlays` exposes the rolling median of `column`
+    """
+    return '{}RollingMedian'.format(column)
+
+
+class SummaryStatistics:
+    """
+    Incrementally maintained summary statistics over a set of columns of a (flattened) Relion micrographs table.
+
+    Calling `update` with the full, growing table only processes the rows added since the previous call, so keeping the
+    summaries current costs O(1) per new exposure (O(log window) for the rolling quantiles) rather than a pass over the
+    full column on every refresh.
+
+    Parameters
+    ----------
+    columns : list of str
+        The table columns to summarize
+    window : int, optional
+        The number of most recent exposures used for rolling statistics
+    quantiles : iterable of float, optional
+        Quantiles to report, both over the rolling window and (estimated) over all exposures
+    """
+    def __init__(self, columns, window=50, quantiles=(0.1, 0.5, 0.9)):
+        self.columns = list(columns)
+        self.window = window
+        self.quantile_levels = tuple(quantiles)
+        self.row_count = 0
+        self.source = None
+        self.summaries = None
+        self.reset()
+
+    def reset(self):
+        self.row_count = 0
+        self.source = None
+        self.summaries = {col: ColumnSummary(self.window, self.quantile_levels) for col in self.columns}
+
+    def update(self, new_data, source=None):
+        """
+        Consume any rows of `new_data` not yet seen
+
+        Parameters
+        ----------
+        new_data : dict
+            Mapping of column name to a sequence of values, as held in `MotionCtfData.data`
+        source : str, optional
+            The file `new_data` was read from, as held in `MotionCtfData.data_file`. The statistics start over when it
+            changes.
+
+        Returns
+        -------
+        bool
+            Whether any new rows were consumed
+        """
+        if not new_data:
+            return False
+        new_count = len(new_data[self.columns[0]])
+        # A different file, or a shorter table than before, means the underlying data was replaced, so start over
+        if new_count < self.row_count or source != self.source:
+            self.reset()
+            self.source = source
+        if new_count == self.row_count:
+            return False
+        for col in self.columns:
+            summary = self.summaries[col]
+            new_values = new_data[col][self.row_count:new_count]
+            # Indexing a NumPy array element by element is slow; convert the new rows to Python floats in one call
+            if hasattr(new_values, 'tolist'):
+                new_values = new_values.tolist()
+            summary.extend([float(value) for value in new_values])
+        self.row_count = new_count
+        return True
+
+    @property
+    def overlays(self):
+        """
+        Per-exposure derived traces (currently the rolling median of every column), keyed by `rolling_median_key`
+        """
+        return {rolling_median_key(col): self.summaries[col].rolling_median for col in self.columns}
+
+    def summary_rows(self, labels=None):
+        """
+        Format the current statistics as a list of row dicts, one per column, suitable for a Dash DataTable
+
+        Parameters
+        ----------
+        labels : dict, optional
+            Human-readable names for each column
+
+        Returns
+        -------
+        list of dict
+        """
+        rows = []
+        for col in self.columns:
+            summary = self.summaries[col]
+            row = {'column': labels.get(col, col) if labels else col,
+                   'count': summary.moments.count,
+                   'mean': summary.moments.mean,
+                   'std': summary.moments.std,
+                   'min': summary.moments.min,
+                   'max': summary.moments.max}
+            for q in summary.quantiles:
+                row[quantile_key('all', q.p)] = q.value
+            for p in self.quantile_levels:
+                row[quantile_key('recent', p)] = summary.window.quantile(p)
+            rows.append({k: _json_number(v) for k, v in row.items()})
+        return rows
+
+    def summary_table_columns(self):
+        """
+        Column definitions for a Dash DataTable displaying `summary_rows`
+        """
+        columns = [{'name': 'Metric', 'id': 'column'},
+                   {'name': 'Mean', 'id': 'mean'},
+                   {'name': 'Std. dev.', 'id': 'std'}]
+        for p in self.quantile_levels:
+            columns.append({'name': 'P{:g} (all)'.format(p * 100), 'id': quantile_key('all', p)})
+        for p in self.quantile_levels:
+            columns.append({'name': 'P{:g} (last {:d})'.format(p * 100, self.window), 'id': quantile_key('recent', p)})
+        return columns
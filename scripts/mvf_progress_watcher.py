@@ -1,18 +1,26 @@
 #!/usr/bin/env python
 
 import sys
-import cryoemtools.relionstarparser as rsp
 import cryoemtools.image as mrcimage
+from mvf_app.selection import (THRESHOLDS_FILENAME, SelectionThresholds, read_thresholds, selection_mask,
+                               write_thresholds)
+from mvf_app.starfile import read_star_loop, read_star_loops, table_length, write_star_loop, write_star_rows
 import argparse
 import os.path
 from collections import OrderedDict
 from subprocess import run as sysrun
-from subprocess import DEVNULL
+from subprocess import DEVNULL, PIPE, STDOUT, Popen
 import queue
 import threading
 import mrcfile
 from PIL import Image
 import atexit
+import fcntl
+import json
+import logging
+import logging.handlers
+import time
+import traceback
 
 
 def explode_path(path):
@@ -46,15 +54,123 @@ def explode_path(path):
     return allparts
 
 
-def threaded_worker(q):
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A `RotatingFileHandler` for a file appended to by several processes (in detached mode, the watcher and the
+    renderer). Each record is written, and the file rotated, under an exclusive lock on `<filename>.lock`, and the file
+    is reopened first if another process has rotated it since it was opened.
+    """
+    def emit(self, record):
+        with open(self.baseFilename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.stream is not None and not self._is_current():
+                    self.stream.close()
+                    self.stream = None
+                super().emit(record)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _is_current(self):
+        try:
+            return os.stat(self.baseFilename).st_ino == os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+
+class TaskMetrics:
+    """
+    Thread-safe collector of per-task timings, appended as JSON lines to a size-rotated metrics file that may be shared
+    with other processes.
+
+    Each task produces one record with its queue wait time, the durations of its individual stages, the bytes written
+    and whether it failed. `finish_run` adds a summary record for the whole run.
+
+    Parameters
+    ----------
+    path : str or os.PathLike
+        The metrics file, normally `.mvf_progress_metrics` next to `.mvf_progress_hint`
+    max_bytes : int, optional
+        Rotate the metrics file once it grows past this size
+    backup_count : int, optional
+        The number of rotated metrics files to keep
+    """
+    def __init__(self, path, max_bytes=4 * 1024 * 1024, backup_count=3):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.task_count = 0
+        self.failures = 0
+        self.bytes_written = 0
+        self.stage_totals = {}
+        self._logger = logging.getLogger('mvf.progress_metrics')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._handler = SharedRotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self._logger.addHandler(self._handler)
+
+    def record_task(self, func, source, wait, stages, error=None):
+        stages = stages or {}
+        record = {'type': 'task', 'time': time.time(), 'task': func.__name__, 'source': source, 'wait': wait,
+                  'stages': {k: v for k, v in stages.items() if k != 'bytes'}, 'bytes': stages.get('bytes', 0),
+                  'ok': error is None}
+        if error is not None:
+            record['error'] = error
+        with self._lock:
+            self.task_count += 1
+            self.failures += error is not None
+            self.bytes_written += record['bytes']
+            for stage, duration in record['stages'].items():
+                self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + duration
+            self.stage_totals['wait'] = self.stage_totals.get('wait', 0.0) + wait
+            self._logger.info(json.dumps(record))
+
+    def finish_run(self, micrographs, backlog):
+        """
+        Write the summary record for this run
+
+        Parameters
+        ----------
+        micrographs : int
+            The number of micrographs whose previews were generated by this run
+        backlog : int
+            The number of micrographs still waiting for previews at the end of this run (see `preview_backlog`)
+        """
+        now = time.time()
+        record = {'type': 'run', 'time': now, 'started': self.started, 'elapsed': now - self.started,
+                  'micrographs': micrographs, 'backlog': backlog, 'tasks': self.task_count,
+                  'failures': self.failures, 'bytes': self.bytes_written, 'stage_totals': self.stage_totals}
+        with self._lock:
+            self._logger.info(json.dumps(record))
+        self.close()
+
+    def record_backlog(self, backlog):
+        """
+        Write a record of the number of micrographs waiting for previews, for runs that queue previews without rendering
+        any (see `preview_backlog`)
+        """
+        with self._lock:
+            self._logger.info(json.dumps({'type': 'backlog', 'time': time.time(), 'backlog': backlog}))
+
+    def close(self):
+        self._handler.close()
+        self._logger.removeHandler(self._handler)
+
+
+def threaded_worker(q, task_metrics=None, manifest=None):
     """
     This function will consume and execute the contents of a threading.Queue object until it is empty.
 
-    Expected items in the queue are tuples of (function, primary argument, **kwargs)
+    Expected items in the queue are tuples of (function, primary argument, **kwargs, time enqueued). Functions may
+    return a dict of stage timings (and bytes written), which is passed on to `task_metrics` along with the time the
+    item spent waiting in the queue. A failing item is reported to `task_metrics` and does not stop the worker. The
+    outcome of each item is also recorded in `manifest` and saved as soon as the item finishes, so that a run that is
+    killed partway still leaves a record of the previews it completed.
 
     Parameters
     ----------
     q : threading.Queue
+    task_metrics : TaskMetrics, optional
+    manifest : PreviewManifest, optional
 
     Returns
     -------
@@ -62,11 +178,65 @@ def threaded_worker(q):
     """
     while True:
         try:
-            func, fn, kwargs = q.get(block=False)
-            func(fn, **kwargs)
-            q.task_done()
+            func, fn, kwargs, enqueued = q.get(block=False)
         except queue.Empty:
             break
+        wait = time.perf_counter() - enqueued
+        try:
+            try:
+                stages = func(fn, **kwargs)
+                error = None
+            except Exception as exc:
+                stages = None
+                error = '{}: {}'.format(type(exc).__name__, exc)
+                traceback.print_exc()
+            if task_metrics:
+                task_metrics.record_task(func, fn, wait, stages, error)
+            if manifest:
+                manifest.record(func, fn, kwargs, error)
+                manifest.save()
+        finally:
+            # Only once the outcome is recorded, so that it is complete when the queue's join() returns
+            q.task_done()
+
+
+def preview_output(input_file, output_dir=None):
+    """
+    The path of the .png preview of `input_file`: `input_file` with the .png extension appended, in `output_dir` if
+    given
+    """
+    if output_dir:
+        filename = os.path.split(input_file)[-1]
+        return os.path.join(output_dir, filename) + ".png"
+    return input_file + ".png"
+
+
+def temp_output(output):
+    """
+    A temporary path next to the preview `output` to render to before moving it into place with `os.replace`, so that
+    a run killed while writing never leaves a truncated preview at `output`
+    """
+    return '{}.{:d}.{:d}.tmp.png'.format(output, os.getpid(), threading.get_ident())
+
+
+def remove_stale_temp_outputs(directory):
+    """
+    Remove the `temp_output` files in `directory` left behind by processes that were killed while rendering
+    """
+    for filename in os.listdir(directory or '.'):
+        if not filename.endswith('.tmp.png'):
+            continue
+        try:
+            pid = int(filename.split('.')[-4])
+            os.kill(pid, 0)
+        except (ValueError, IndexError, ProcessLookupError):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+        except PermissionError:
+            # The process is alive, but not ours
+            pass
 
 
 def mrc2png(input_file, output_dir=None, resize=0, sigma_contrast=0.0):
@@ -86,14 +256,13 @@ def mrc2png(input_file, output_dir=None, resize=0, sigma_contrast=0.0):
 
     Returns
     -------
-    None
+    dict
+        Seconds spent reading, contrasting, resizing and encoding the image, and the number of bytes written
     """
-    if output_dir:
-        filename = os.path.split(input_file)[-1]
-        output = os.path.join(output_dir, filename) + ".png"
-    else:
-        output = input_file + ".png"
+    output = preview_output(input_file, output_dir)
 
+    timings = {}
+    started = time.perf_counter()
     with mrcfile.open(input_file) as mrc:
         data = mrc.data
     # mrcfile sets the writeable flag to 0 on the underlying data array, but it seems to remain in memory OK?
@@ -102,14 +271,26 @@ def mrc2png(input_file, output_dir=None, resize=0, sigma_contrast=0.0):
     # CTFFind writes out .mrc files with an improperly-set header byte so an extra dimension gets added by mrcfile
     if len(data.shape) > 2:
         data = data.squeeze()
+    timings['read'], started = time.perf_counter() - started, time.perf_counter()
     if sigma_contrast:
         mrcimage.sigma_contrast(data, sigma=sigma_contrast, new_range=(0, 255), inplace=True)
     img = mrcimage.arr_to_img(data, scale=(not sigma_contrast))
+    timings['contrast'], started = time.perf_counter() - started, time.perf_counter()
     if resize:
         # numpy data has shape (height, width). could also use img.size, which is (width, height)
         new_height = int(data.shape[0] * resize / data.shape[1])
         img = img.resize((resize, new_height), resample=Image.LANCZOS)
-    img.save(output, format='png', compress_level=9)
+    timings['resize'], started = time.perf_counter() - started, time.perf_counter()
+    temp_path = temp_output(output)
+    try:
+        img.save(temp_path, format='png', compress_level=9)
+        timings['bytes'] = os.path.getsize(temp_path)
+        os.replace(temp_path, output)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    timings['encode'] = time.perf_counter() - started
+    return timings
 
 
 def ctf2png(input_file, output_dir=None, size=None):
@@ -127,17 +308,590 @@ def ctf2png(input_file, output_dir=None, size=None):
 
     Returns
     -------
-    None
+    dict
+        Seconds spent plotting, and the number of bytes written
+
+    Raises
+    ------
+    RuntimeError
+        If the plotting script exits with an error or writes no output
     """
-    if output_dir:
-        filename = os.path.split(input_file)[-1]
-        output = os.path.join(output_dir, filename) + ".png"
-    else:
-        output = input_file + ".png"
-    if size:
-        sysrun(['ctffind_plot_results_png.sh', input_file, output, str(size)], stdout=DEVNULL)
+    output = preview_output(input_file, output_dir)
+    temp_path = temp_output(output)
+    started = time.perf_counter()
+    try:
+        if size:
+            result = sysrun(['ctffind_plot_results_png.sh', input_file, temp_path, str(size)],
+                            stdout=DEVNULL, stderr=PIPE)
+        else:
+            result = sysrun(['ctffind_plot_results_png.sh', input_file, temp_path], stdout=DEVNULL, stderr=PIPE)
+        plot_time = time.perf_counter() - started
+        if result.returncode != 0 or not os.path.isfile(temp_path):
+            raise RuntimeError("ctffind_plot_results_png.sh exited with status {:d}: {}".format(
+                result.returncode, result.stderr.decode(errors='replace').strip()))
+        size_written = os.path.getsize(temp_path)
+        os.replace(temp_path, output)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    return {'plot': plot_time, 'bytes': size_written}
+
+
+PREVIEW_FUNCTIONS = {f.__name__: f for f in (mrc2png, ctf2png)}
+
+
+def preview_tasks(micrograph_names, ctf_images, args):
+    """
+    List the preview images to generate for each micrograph
+
+    Parameters
+    ----------
+    micrograph_names : list of str
+        The rlnMicrographName of each micrograph
+    ctf_images : list of str
+        The matching rlnCtfImage of each micrograph
+    args : argparse.Namespace
+        The parsed command line, for the image sizes and contrast
+
+    Returns
+    -------
+    list of tuple
+        (micrograph name, function, primary argument, **kwargs) for each preview
+    """
+    tasks = []
+    for micrograph_path, ctf_image in zip(micrograph_names, ctf_images):
+        ctf_fft_path = ctf_image[:-4]
+        ctf_avrot_path = ctf_fft_path[:-4] + '_avrot.txt'
+        tasks.append((micrograph_path, mrc2png, micrograph_path,
+                      {'output_dir': 'Previews/', 'resize': args.mic_png_size,
+                       'sigma_contrast': args.mic_sigma_contrast}))
+        tasks.append((micrograph_path, mrc2png, ctf_fft_path, {'output_dir': 'Previews/', 'resize': args.fft_png_size}))
+        tasks.append((micrograph_path, ctf2png, ctf_avrot_path,
+                      {'output_dir': 'Previews/', 'size': args.ctf_png_size}))
+    return tasks
+
+
+def run_tasks(tasks, threads, task_metrics, manifest=None):
+    """
+    Execute `tasks` (as returned by `preview_tasks`) on `threads` worker threads, returning once all are done
+    """
+    for directory in set(os.path.dirname(task_output(task)) for task in tasks):
+        remove_stale_temp_outputs(directory)
+    to_do = queue.Queue()
+    for _, func, fn, kwargs in tasks:
+        to_do.put((func, fn, kwargs, time.perf_counter()))
+    for _ in range(threads):
+        t = threading.Thread(target=threaded_worker, args=[to_do, task_metrics, manifest])
+        t.start()
+    to_do.join()
+
+
+####
+#
+# The preview manifest records what has been rendered from what, so that restarts and re-runs only do the work that
+# was actually left undone
+#
+# Append-only JSON lines log of rendered (or adopted) previews; the last record for an output wins
+PREVIEW_MANIFEST = os.path.join('Previews', '.mvf_preview_manifest')
+# The small index of failed previews awaiting a retry, rewritten whenever it changes
+PREVIEW_RETRIES = os.path.join('Previews', '.mvf_preview_retries.json')
+
+
+def _source_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _preview_params(kwargs):
+    return {k: v for k, v in kwargs.items() if k != 'output_dir'}
+
+
+def task_output(task):
+    """
+    The output path of a task as returned by `preview_tasks`
+    """
+    return preview_output(task[2], task[3].get('output_dir'))
+
+
+def task_record(task):
+    """
+    A JSON-serializable record of a task as returned by `preview_tasks`, the inverse of `task_from_record`
+    """
+    micrograph, func, fn, kwargs = task
+    return {'micrograph': micrograph, 'func': func.__name__, 'source': fn, 'kwargs': kwargs}
+
+
+def task_from_record(record):
+    return record['micrograph'], PREVIEW_FUNCTIONS[record['func']], record['source'], record['kwargs']
+
+
+class PreviewManifest:
+    """
+    Tracks which previews are up to date, so that only missing or stale ones are rendered.
+
+    Each rendered preview is recorded in an append-only log (`PREVIEW_MANIFEST`) with its source file's size and mtime
+    and the rendering parameters. A preview needs rendering if its output is missing, or its source or parameters have
+    changed since it was recorded. A preview with no record whose output is newer than its source (e.g. rendered before
+    the manifest existed) is adopted instead of rendered again. The log is only read when a preview's output already
+    exists, so checking the previews of new micrographs costs a stat or two each.
+
+    Failed previews are kept in a small separate index (`PREVIEW_RETRIES`) and retried with exponential backoff;
+    `due_retries` lists those whose retry time has come without touching the log.
+
+    `save` appends to the log and merges into the retry index under an exclusive lock, so that an attached watcher and
+    a detached renderer can share one manifest.
+
+    Parameters
+    ----------
+    path : str or os.PathLike, optional
+    retries_path : str or os.PathLike, optional
+    retry_delay : float, optional
+        Seconds to wait before the first retry of a failed preview; doubled after each further failure
+    max_retry_delay : float, optional
+        The longest wait between retries
+    """
+    def __init__(self, path=PREVIEW_MANIFEST, retries_path=PREVIEW_RETRIES, retry_delay=60.0, max_retry_delay=3600.0):
+        self.path = path
+        self.retries_path = retries_path
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        # Read on first use by `_entry`
+        self._entries = None
+        self._new_entries = []
+        # Output -> new retry entry, or None once rendered successfully
+        self._retry_changes = {}
+        # Output -> micrograph of the tasks passed through `pending`, for the retry index
+        self._micrographs = {}
+        self.retries = self._read_retries()
+
+    def _read_retries(self):
+        try:
+            with open(self.retries_path, 'r') as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print("Ignoring unreadable preview retry index {}".format(self.retries_path), file=sys.stderr)
+            return {}
+
+    def _entry(self, output):
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                try:
+                    with open(self.path, 'r') as fh:
+                        for line in fh:
+                            try:
+                                entry = json.loads(line)
+                                self._entries[entry['output']] = entry
+                            except (ValueError, KeyError):
+                                continue
+                except FileNotFoundError:
+                    pass
+            return self._entries.get(output)
+
+    def _add_entry(self, fn, kwargs, output, status):
+        source = _source_signature(fn) or {'size': None, 'mtime': None}
+        entry = {'output': output, 'source': fn, 'size': source['size'], 'mtime': source['mtime'],
+                 'params': _preview_params(kwargs), 'status': status, 'updated': time.time()}
+        with self._lock:
+            self._new_entries.append(entry)
+            if self._entries is not None:
+                self._entries[output] = entry
+
+    def needs_render(self, task, now=None):
+        """
+        Whether the preview made by `task` (as returned by `preview_tasks`) must be rendered (again)
+        """
+        _, _, fn, kwargs = task
+        output = task_output(task)
+        source = _source_signature(fn)
+        retry = self.retries.get(output)
+        if retry is not None:
+            changed = source is not None and (source['size'] != retry['size'] or source['mtime'] != retry['mtime'])
+            return changed or (now or time.time()) >= retry['retry_at']
+        output_signature = _source_signature(output)
+        if output_signature is None:
+            return True
+        entry = self._entry(output)
+        if entry is None:
+            if source is None or output_signature['mtime'] >= source['mtime']:
+                self._add_entry(fn, kwargs, output, 'adopted')
+                return False
+            return True
+        # A vanished source can't be rendered again; keep whatever was made from it
+        changed = source is not None and (source['size'] != entry['size'] or source['mtime'] != entry['mtime'])
+        return changed or entry['params'] != _preview_params(kwargs)
+
+    def record(self, func, fn, kwargs, error=None):
+        """
+        Record the outcome of rendering the preview of `fn` with `func` and `kwargs`
+        """
+        output = preview_output(fn, kwargs.get('output_dir'))
+        if error is None:
+            self._add_entry(fn, kwargs, output, 'ok')
+            with self._lock:
+                if output in self.retries or output in self._retry_changes:
+                    self._retry_changes[output] = None
+            return
+        source = _source_signature(fn) or {'size': None, 'mtime': None}
+        with self._lock:
+            previous = self._retry_changes.get(output) or self.retries.get(output)
+            attempts = previous['attempts'] + 1 if previous else 1
+            delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+            task = (self._micrographs.get(output, fn), func, fn, kwargs)
+            self._retry_changes[output] = dict(task_record(task), size=source['size'], mtime=source['mtime'],
+                                               attempts=attempts, retry_at=time.time() + delay, error=error)
+
+    def due_retries(self, now=None):
+        """
+        The tasks of failed previews whose retry time has come
+        """
+        now = now or time.time()
+        return [task_from_record(retry) for retry in self.retries.values() if now >= retry['retry_at']]
+
+    def pending(self, tasks):
+        """
+        Filter `tasks` (as returned by `preview_tasks`) down to those that need rendering, dropping duplicates
+        """
+        now = time.time()
+        seen = set()
+        pending = []
+        for task in tasks:
+            output = task_output(task)
+            if output not in seen and self.needs_render(task, now):
+                pending.append(task)
+                self._micrographs[output] = task[0]
+            seen.add(output)
+        return pending
+
+    def save(self):
+        """
+        Append the previews recorded since the last save to the log, and merge retry changes into the retry index
+        """
+        with self._lock:
+            new_entries, self._new_entries = self._new_entries, []
+            retry_changes, self._retry_changes = self._retry_changes, {}
+        if not new_entries and not retry_changes:
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if new_entries:
+                    with open(self.path, 'a') as fh:
+                        fh.writelines(json.dumps(entry, separators=(',', ':')) + "\n" for entry in new_entries)
+                if retry_changes:
+                    retries = self._read_retries()
+                    for output, retry in retry_changes.items():
+                        if retry is None:
+                            retries.pop(output, None)
+                        else:
+                            retries[output] = retry
+                    temp_path = '{}.{:d}.tmp'.format(self.retries_path, os.getpid())
+                    with open(temp_path, 'w') as fh:
+                        json.dump(retries, fh)
+                    os.replace(temp_path, self.retries_path)
+                    self.retries = retries
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+####
+#
+# Detached preview rendering: the watcher appends tasks to a persistent queue and returns to Relion at once, and a
+# single background renderer process drains the queue
+#
+PREVIEW_QUEUE = os.path.join('Previews', '.mvf_preview_queue')
+# Tasks claimed by the renderer but not yet finished; re-run by the next renderer if this one dies
+PREVIEW_CLAIMED = os.path.join('Previews', '.mvf_preview_queue.claimed')
+RENDERER_LOCK = os.path.join('Previews', '.mvf_renderer.lock')
+RENDERER_LOG = os.path.join('Previews', '.mvf_renderer.log')
+# JSON summary of the renderer's progress, for monitoring preview completion separately from the Relion job status
+RENDERER_STATUS = os.path.join('Previews', '.mvf_preview_status')
+
+
+def enqueue_previews(tasks):
+    """
+    Append preview tasks to the persistent queue as JSON lines, holding an exclusive lock on the queue file
+
+    Parameters
+    ----------
+    tasks : list of tuple
+        As returned by `preview_tasks`
+    """
+    now = time.time()
+    lines = [json.dumps(dict(task_record(task), enqueued=now)) + "\n" for task in tasks]
+    with open(PREVIEW_QUEUE, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            fh.writelines(lines)
+            fh.flush()
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _load_tasks(lines):
+    tasks = []
+    for line in lines:
+        try:
+            tasks.append(task_from_record(json.loads(line)))
+        except (ValueError, KeyError):
+            print("Skipping unreadable preview queue entry: {!r}".format(line), file=sys.stderr)
+    return tasks
+
+
+def claim_previews():
+    """
+    Move every task in the persistent queue to the claimed file and return the claimed tasks. Tasks left claimed by a
+    renderer that died are returned again first.
+    """
+    lines = []
+    if os.path.isfile(PREVIEW_CLAIMED):
+        with open(PREVIEW_CLAIMED, 'r') as fh:
+            lines.extend(fh)
+    if os.path.isfile(PREVIEW_QUEUE):
+        with open(PREVIEW_QUEUE, 'r+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                queued = fh.readlines()
+                if queued:
+                    # Persist the claim before emptying the queue, so that no task is lost if we're killed in between
+                    with open(PREVIEW_CLAIMED, 'a') as claimed:
+                        claimed.writelines(queued)
+                        claimed.flush()
+                        os.fsync(claimed.fileno())
+                    fh.seek(0)
+                    fh.truncate()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+            lines.extend(queued)
+    tasks = _load_tasks(line for line in lines if line.strip())
+    if not tasks and os.path.isfile(PREVIEW_CLAIMED):
+        # Nothing claimed could be read; left in place, the claim would start a new renderer on every watcher run
+        os.remove(PREVIEW_CLAIMED)
+    return tasks
+
+
+def queued_tasks():
+    """
+    Every task waiting in the persistent queue or claimed by the renderer
+    """
+    tasks = []
+    for path in (PREVIEW_QUEUE, PREVIEW_CLAIMED):
+        try:
+            with open(path, 'r') as fh:
+                lines = fh.readlines()
+        except FileNotFoundError:
+            continue
+        tasks.extend(_load_tasks(line for line in lines if line.strip()))
+    return tasks
+
+
+def preview_backlog(manifest, unmerged=0):
+    """
+    The number of micrographs still waiting for an up-to-date preview: those with a preview queued for or claimed by
+    the detached renderer or awaiting a retry after failing, plus `unmerged` rows not yet in micrographs.star
+    """
+    micrographs = set(task[0] for task in queued_tasks())
+    micrographs.update(retry['micrograph'] for retry in manifest.retries.values())
+    return len(micrographs) + unmerged
+
+
+def queue_is_empty():
+    try:
+        return os.path.getsize(PREVIEW_QUEUE) == 0
+    except FileNotFoundError:
+        return True
+
+
+def write_renderer_status(**status):
+    status.update({'pid': os.getpid(), 'updated': time.time()})
+    temp_path = RENDERER_STATUS + '.tmp'
+    with open(temp_path, 'w') as fh:
+        json.dump(status, fh)
+    os.replace(temp_path, RENDERER_STATUS)
+
+
+def acquire_renderer_lock():
+    """
+    Take the single-instance renderer lock without blocking
+
+    Returns
+    -------
+    file or None
+        The open lock file, to be passed to `release_renderer_lock`, or None if another renderer holds the lock
+    """
+    fh = open(RENDERER_LOCK, 'a')
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return None
+    return fh
+
+
+def release_renderer_lock(fh):
+    fcntl.flock(fh, fcntl.LOCK_UN)
+    fh.close()
+
+
+def render_queue(threads):
+    """
+    Drain the persistent preview queue, then exit. Only one renderer runs at a time; a second one exits immediately,
+    leaving the tasks it was started for to the running renderer.
+
+    Parameters
+    ----------
+    threads : int
+        The number of worker threads to render with
+    """
+    lock = acquire_renderer_lock()
+    if lock is None:
+        return
+    completed = failures = 0
+    while True:
+        claimed = claim_previews()
+        if claimed:
+            # Tasks may have been queued more than once, or already rendered by an attached run
+            manifest = PreviewManifest()
+            tasks = manifest.pending(claimed)
+            micrographs = len(set(task[0] for task in tasks))
+            write_renderer_status(state='rendering', claimed=len(tasks), completed=completed, failures=failures)
+            task_metrics = TaskMetrics('.mvf_progress_metrics')
+            run_tasks(tasks, threads, task_metrics, manifest)
+            manifest.save()
+            completed += task_metrics.task_count - task_metrics.failures
+            failures += task_metrics.failures
+            os.remove(PREVIEW_CLAIMED)
+            task_metrics.finish_run(micrographs, preview_backlog(manifest))
+            continue
+        # Release the lock before the final check of the queue: a watcher that enqueues after this point either sees
+        # the lock free and starts a new renderer, or we see its tasks here and carry on
+        write_renderer_status(state='idle', claimed=0, completed=completed, failures=failures)
+        release_renderer_lock(lock)
+        if queue_is_empty():
+            break
+        lock = acquire_renderer_lock()
+        if lock is None:
+            break
+
+
+def spawn_renderer(threads):
+    """
+    Start `render_queue` in a detached process (its own session, so that it outlives this job), logging to
+    Previews/.mvf_renderer.log
+    """
+    with open(RENDERER_LOG, 'a') as log:
+        Popen([sys.executable, os.path.abspath(__file__), '--render_queue', '--j', str(threads)],
+              stdin=DEVNULL, stdout=log, stderr=STDOUT, start_new_session=True, close_fds=True)
+
+
+####
+#
+# Threshold-based micrograph selection, written to selected_micrographs.star for downstream jobs
+#
+SELECTION_STATE = '.mvf_selection_state'
+
+
+def selection_thresholds(args):
+    """
+    The selection thresholds to apply: those in the project's .mvf_selection_thresholds (as adjusted from the mvf app)
+    if it exists, otherwise those given on the command line. The command line thresholds are then saved to
+    .mvf_selection_thresholds, so that the mvf app shows and evaluates the thresholds actually applied.
+    """
+    thresholds = read_thresholds(THRESHOLDS_FILENAME)
+    if thresholds is None:
+        thresholds = SelectionThresholds(args.max_resolution, args.max_motion, args.min_defocus, args.max_defocus)
+        write_thresholds(THRESHOLDS_FILENAME, thresholds)
+    return thresholds
+
+
+def update_selection(job_dir, optics, output_mics, thresholds):
+    """
+    Bring `job_dir`/selected_micrographs.star up to date with the rows of `output_mics` that pass `thresholds`.
+
+    Only rows added since the previous run are evaluated and appended, unless the thresholds have changed (or the
+    previous selection is missing, inconsistent or was written with its micrographs loop terminated), in which case the
+    whole file is rewritten. The micrographs loop is left open at the end of the file so that appended rows extend it.
+
+    Returns
+    -------
+    bool
+        Whether the selection file was created or changed
+    """
+    selected_path = os.path.join(job_dir, 'selected_micrographs.star')
+    state_path = os.path.join(job_dir, SELECTION_STATE)
+    try:
+        with open(state_path, 'r') as fh:
+            state = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        state = None
+    row_count = table_length(output_mics)
+    append = (state is not None and state.get('thresholds') == thresholds.to_dict() and state.get('open_loop') and
+              os.path.isfile(selected_path) and state.get('rows', 0) <= row_count)
+    start = state['rows'] if append else 0
+    if append and start == row_count:
+        return False
+
+    mask = selection_mask(output_mics, thresholds, start, row_count)
+    selected_rows = [start + i for i in mask.nonzero()[0]]
+    selected = OrderedDict((col, [values[i] for i in selected_rows]) for col, values in output_mics.items())
+    if append:
+        with open(selected_path, 'a') as fh:
+            write_star_rows(fh, selected)
+        accepted = state['accepted'] + len(selected_rows)
     else:
-        sysrun(['ctffind_plot_results_png.sh', input_file, output], stdout=DEVNULL)
+        # Downstream jobs may be reading the previous selection, so replace it atomically
+        temp_path = selected_path + '.tmp'
+        with open(temp_path, 'w') as fh:
+            write_star_loop(fh, optics, 'optics')
+            write_star_loop(fh, selected, 'micrographs', terminate=False)
+        os.replace(temp_path, selected_path)
+        accepted = len(selected_rows)
+
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w') as fh:
+        json.dump({'thresholds': thresholds.to_dict(), 'rows': row_count, 'accepted': accepted, 'open_loop': True}, fh)
+    os.replace(temp_path, state_path)
+    return True
+
+
+def write_output_nodes(job_dir, output_path):
+    """
+    Write out a .star file that will make micrographs.star, and selected_micrographs.star if there is one, usable in
+    the Relion GUI as input to future jobs
+    """
+    nodes = [output_path]
+    selected_path = os.path.join(job_dir, 'selected_micrographs.star')
+    if os.path.isfile(selected_path):
+        nodes.append(selected_path)
+    with open(os.path.join(job_dir, 'RELION_OUTPUT_NODES.star'), 'w') as fh:
+        contents = OrderedDict((('rlnPipeLineNodeName', nodes), ('rlnPipeLineNodeType', [1] * len(nodes))))
+        write_star_loop(fh, contents, 'output_nodes')
+
+
+def write_outputs(output_path, optics, output_mics, job_dir):
+    """
+    Write the consolidated micrographs.star, the RELION_OUTPUT_NODES.star making it available to later Relion jobs, and
+    the .mvf_progress_hint for the mvf app
+    """
+    # Write a new micrographs.star, preserving the data_optics table too
+    with open(output_path, 'w') as fh:
+        write_star_loop(fh, optics, 'optics')
+        write_star_loop(fh, output_mics, 'micrographs')
+
+    write_output_nodes(job_dir, output_path)
+
+    # Write out hints to the mvf app frontend as a simple file listing the output dir and micrograph count
+    with open('.mvf_progress_hint', 'w') as fh:
+        fh.write(output_path)
+        fh.write(" ")
+        fh.write(str(table_length(output_mics)))
+        fh.write("\n")
 
 
 def touch_file(file_path):
@@ -224,25 +978,46 @@ def main():
     parser = argparse.ArgumentParser(description="Consolidate Relion MotionCorr and CtfFind jobs and generate preview "
                                                  "images for use with the mvf web display",
                                      epilog="https://github.com/fullerjamesr/mvf")
-    parser.add_argument("--o", required=True)
-    parser.add_argument("--in_mics", required=True)
+    parser.add_argument("--o")
+    parser.add_argument("--in_mics")
     parser.add_argument("--j", type=int, default=1)
     parser.add_argument("--mic_png_size", type=int, default=1448)
     parser.add_argument("--fft_png_size", type=int, default=0)
     parser.add_argument("--ctf_png_size", type=int, default=0)
     parser.add_argument("--mic_sigma_contrast", type=float, default=2.0)
+    parser.add_argument("--max_resolution", type=float, default=None,
+                        help="Select micrographs whose CTF fit resolution is at most this (Å)")
+    parser.add_argument("--max_motion", type=float, default=None,
+                        help="Select micrographs whose total motion is at most this (Å)")
+    parser.add_argument("--min_defocus", type=float, default=None,
+                        help="Select micrographs whose defocus is at least this (Å)")
+    parser.add_argument("--max_defocus", type=float, default=None,
+                        help="Select micrographs whose defocus is at most this (Å)")
+    parser.add_argument("--preview_mode", choices=['attached', 'detached'], default='attached',
+                        help="'attached' generates previews before exiting; 'detached' writes the outputs, queues the "
+                             "previews for a background renderer and exits immediately")
+    # Internal: run as the detached background renderer
+    parser.add_argument("--render_queue", action='store_true', help=argparse.SUPPRESS)
     args = parser.parse_args()
 
+    if args.render_queue:
+        render_queue(args.j)
+        return
+    if not args.o or not args.in_mics:
+        parser.error("the following arguments are required: --o, --in_mics")
+
     # Engage the scaffolding that will touch the appropriate filenames to indicate success or failure to Relion
     atexit.register(normal_exit, args.o)
     sys.excepthook = signal_failure_factory(args.o)
     # ...and remove any old status indicator files
     clear_prior_exits(args.o)
 
-    ctf_star = rsp.read_star(args.in_mics, tablefmt=rsp.TableFormat.LIST_OF_ROW_DICTS, convert_numeric=False)
+    # All tables are read column-wise, as lists of unconverted strings
+    ctf_star = read_star_loops(args.in_mics, blocks=['optics', 'micrographs'], convert_numeric=False, fallback=True)
     # no point in running if there's nothing to process
-    if 'micrographs' not in ctf_star or len(ctf_star['micrographs']) == 0:
+    if 'micrographs' not in ctf_star or table_length(ctf_star['micrographs']) == 0:
         return
+    ctf_mics = ctf_star['micrographs']
 
     # TODO: Huge assumption past this point: that any input to this job is a superset of the rows already processed,
     #   that the two are sorted the same, all come from the same single MotionCorr job, and nothing needs to change with
@@ -250,73 +1025,87 @@ def main():
 
     output_path = os.path.join(args.o, 'micrographs.star')
     if os.path.isfile(output_path):
-        previous_output_mics = rsp.read_star(output_path, block_list=['micrographs'], flatten=True,
-                                             convert_numeric=False,
-                                             tablefmt=rsp.TableFormat.LIST_OF_ROW_DICTS)
+        previous_output_mics = read_star_loop(output_path, 'micrographs', convert_numeric=False, fallback=True)
     else:
-        previous_output_mics = []
+        previous_output_mics = OrderedDict()
 
-    # ...or if there's nothing new
-    if len(previous_output_mics) == len(ctf_star['micrographs']):
-        return
+    has_new_rows = table_length(previous_output_mics) != table_length(ctf_mics)
+    if has_new_rows:
+        # rlnMicrographName records will be like:
+        #     MotionCorr/jobXXX/arbitrary/raw/data/organization/file.mrc
+        # Need to extract the first two path chunks to locate the MotionCorr output directory
+        moco_star_path = os.path.join(*explode_path(ctf_mics['rlnMicrographName'][0])[:2],
+                                      'corrected_micrographs.star')
+        moco_mics = read_star_loop(moco_star_path, 'micrographs', convert_numeric=False, fallback=True)
 
-    # rlnMicrographName records will be like:
-    #     MotionCorr/jobXXX/arbitrary/raw/data/organization/file.mrc
-    # Need to extract the first two path chunks to locate the MotionCorr output directory
-    moco_star_path = os.path.join(*explode_path(ctf_star['micrographs'][0]['rlnMicrographName'])[:2],
-                                  'corrected_micrographs.star')
-    moco_star = rsp.read_star(moco_star_path, block_list=['micrographs'], flatten=True, convert_numeric=False,
-                              tablefmt=rsp.TableFormat.LIST_OF_ROW_DICTS)
-
-    # Take advantage of the time-sorted nature of the entries to skip to the new ones, do the following:
-    #  * Add new rows to the previous output
-    #  * For new rows, create .png previews in the Previews/ directory for the web server of:
-    #   - The micrograph
-    #   - The FFT/idealized CTF previews written by CTFFind
-    #   - The gnuplot output from CTFFind
-    if not os.path.isdir('Previews'):
-        os.mkdir('Previews')
-    first_new_line = len(previous_output_mics)
-    to_do = queue.Queue()
-    for new_row, moco_row in zip(ctf_star['micrographs'][first_new_line:], moco_star[first_new_line:]):
-        new_row.update(moco_row)
-        previous_output_mics.append(new_row)
+        # Take advantage of the time-sorted nature of the entries to skip to the new ones and add them to the previous
+        # output. The new rows are the CtfFind columns with the MotionCorr columns merged in (overwriting any of the
+        # same name)
+        first_new_line = table_length(previous_output_mics)
+        last_new_line = min(table_length(ctf_mics), table_length(moco_mics))
+        new_mics = OrderedDict((col, values[first_new_line:last_new_line]) for col, values in ctf_mics.items())
+        new_mics.update((col, values[first_new_line:last_new_line]) for col, values in moco_mics.items())
+        output_mics = OrderedDict((col, (previous_output_mics[col] if previous_output_mics else []) + values)
+                                  for col, values in new_mics.items())
+    else:
+        new_mics = None
+        output_mics = previous_output_mics
 
-        micrograph_path = new_row['rlnMicrographName']
-        ctf_fft_path = new_row['rlnCtfImage'][:-4]
-        ctf_avrot_path = ctf_fft_path[:-4] + '_avrot.txt'
+    # Keep selected_micrographs.star in step with the output: new rows are appended as they arrive, and the whole
+    # selection is redone when the thresholds change (e.g. from the mvf app)
+    thresholds = selection_thresholds(args)
+    if thresholds.active or os.path.isfile(os.path.join(args.o, 'selected_micrographs.star')):
+        if update_selection(args.o, ctf_star['optics'], output_mics, thresholds) and not has_new_rows:
+            write_output_nodes(args.o, output_path)
 
-        # mrc2png(micrograph_path, output_dir='Previews/',
-        #         resize=args.mic_png_size, sigma_contrast=args.mic_sigma_contrast)
-        to_do.put((mrc2png, micrograph_path,
-                   {'output_dir': 'Previews/', 'resize': args.mic_png_size, 'sigma_contrast': args.mic_sigma_contrast}))
-        # mrc2png(ctf_fft_path, output_dir='Previews/', resize=args.fft_png_size)
-        to_do.put((mrc2png, ctf_fft_path,
-                   {'output_dir': 'Previews/', 'resize': args.fft_png_size}))
-        # ctf2png(ctf_avrot_path, output_dir='Previews/', size=args.ctf_png_size)
-        to_do.put((ctf2png, ctf_avrot_path, {'output_dir': 'Previews/', 'size': args.ctf_png_size}))
-
-    for _ in range(args.j):
-        t = threading.Thread(target=threaded_worker, args=[to_do])
-        t.start()
-    to_do.join()
-
-    # Write a new micrographs.star, preserving the data_optics table too
-    with open(output_path, 'w') as fh:
-        rsp.write_table(fh, ctf_star['optics'], block_name='optics', inputfmt=rsp.TableFormat.LIST_OF_ROW_DICTS)
-        rsp.write_table(fh, previous_output_mics, block_name='micrographs', inputfmt=rsp.TableFormat.LIST_OF_ROW_DICTS)
+    # Create .png previews in the Previews/ directory for the web server of:
+    #  - The micrograph
+    #  - The FFT/idealized CTF previews written by CTFFind
+    #  - The gnuplot output from CTFFind
+    # for the new rows, plus any earlier ones whose previews failed and are due for a retry. Previews that are already
+    # up to date (e.g. rendered by a run that died before updating micrographs.star) are skipped.
+    if not os.path.isdir('Previews'):
+        os.mkdir('Previews')
+    manifest = PreviewManifest()
+    candidates = manifest.due_retries()
+    if not has_new_rows and not candidates:
+        # Nothing new; just make sure that a renderer that died leaves no queued previews behind
+        if args.preview_mode == 'detached' and (not queue_is_empty() or os.path.isfile(PREVIEW_CLAIMED)):
+            spawn_renderer(args.j)
+        return
+    if has_new_rows:
+        candidates = preview_tasks(new_mics['rlnMicrographName'], new_mics['rlnCtfImage'], args) + candidates
+    tasks = manifest.pending(candidates)
+    micrographs = len(set(task[0] for task in tasks))
+    # CtfFind rows still waiting for their MotionCorr counterparts have no previews yet either
+    unmerged = table_length(ctf_mics) - table_length(output_mics)
 
-    # Write out a .star file that will make the micrographs.star output usable in the Relion GUI as input to future jobs
-    with open(os.path.join(args.o, 'RELION_OUTPUT_NODES.star'), 'w') as fh:
-        contents = OrderedDict((('rlnPipeLineNodeName', [output_path]), ('rlnPipeLineNodeType', [1])))
-        rsp.write_table(fh, contents, block_name='output_nodes')
+    if args.preview_mode == 'detached':
+        already_queued = set(task_output(task) for task in queued_tasks())
+        tasks = [task for task in tasks if task_output(task) not in already_queued]
+        # Record any adopted previews
+        manifest.save()
+        if tasks:
+            enqueue_previews(tasks)
+        # Publish the new rows straight away and leave the previews to the background renderer. Until a preview is
+        # rendered, the mvf app's image route returns 404 for it.
+        if has_new_rows:
+            write_outputs(output_path, ctf_star['optics'], output_mics, args.o)
+        task_metrics = TaskMetrics('.mvf_progress_metrics')
+        task_metrics.record_backlog(preview_backlog(manifest, unmerged))
+        task_metrics.close()
+        if not queue_is_empty():
+            spawn_renderer(args.j)
+        return
 
-    # Write out hints to the mvf app frontend as a simple file listing the output dir and micrograph count
-    with open('.mvf_progress_hint', 'w') as fh:
-        fh.write(output_path)
-        fh.write(" ")
-        fh.write(str(len(previous_output_mics)))
-        fh.write("\n")
+    task_metrics = TaskMetrics('.mvf_progress_metrics')
+    try:
+        run_tasks(tasks, args.j, task_metrics, manifest)
+    finally:
+        manifest.save()
+    task_metrics.finish_run(micrographs, preview_backlog(manifest, unmerged))
+    if has_new_rows:
+        write_outputs(output_path, ctf_star['optics'], output_mics, args.o)
 
 
 if __name__ == '__main__':